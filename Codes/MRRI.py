@@ -1,27 +1,77 @@
 import os
-import sys
-import subprocess as s
 from subprocess import Popen
 import argparse
 from typing import List, Tuple
 import pandas as pd
 import re
 from itertools import groupby
+from Codes.intarna_backend import SubprocessBackend, CachedBackend
+from Codes.cache import parameter_file_content
+from Codes.accessibility import (profile_width, index_to_position, parse_accessibility,
+                                 profile_to_bytes, profile_from_bytes)
+
+
+class MRRIParameters():
+    '''
+        Settings shared by the MRRI handlers of many genomes, set up once.
+        Offers the attributes of the parsed command line used by MRRI
+        (parameterFile, intarnaBin, backend, cache), so it can be passed as args.
+    '''
+
+    def __init__(self, parameterFile="", intarnaBin="IntaRNA", backend=None, cache=None):
+        '''
+            parameterFile (str): Optional IntaRNA parameter file
+            intarnaBin (str): IntaRNA binary, used if no backend is given
+            backend (IntaRNABackend): Backend running IntaRNA (default: SubprocessBackend)
+            cache (ResultCache): Optional cache for the IntaRNA outputs and ED profiles
+        '''
+        self.parameterFile = parameterFile
+        self.intarnaBin = intarnaBin
+        self.backend = backend or SubprocessBackend(intarnaBin)
+        self.cache = cache
 
 
 class MRRI():
 
-    def __init__(self, args):
+    def __init__(self, args, query=None, target=None):
         '''
             Constructor for the MRRI class with default value from args
+            query/target override args.query/args.target if given
         '''
         self.regex = "[ACGTUacgtu]+"
         self.args = args
-        self.querySeq = self.parseFasta2dict( args.query, 'query' ) # dictionary of queryID 2 query sequence
-        self.targetSeq = self.parseFasta2dict( args.target, 'target' ) # dictionary of targetID 2 target sequence
+        self.querySeq = self.parseFasta2dict( args.query if query is None else query, 'query' ) # dictionary of queryID 2 query sequence
+        self.targetSeq = self.parseFasta2dict( args.target if target is None else target, 'target' ) # dictionary of targetID 2 target sequence
         self.b1 = None
         self.b2 = None
         self.b3 = None
+        self.predictions = {} # (ids, param_mode, blocked t ranges, blocked q ranges) => block already predicted
+        self.accessibility = {} # (side, sequence) => ED profile, computed on the first ED lookup
+        self.cache = None
+        # backend running the IntaRNA predictions, shared by all rounds of this handler
+        self.backend = getattr(args, "backend", None) or SubprocessBackend(args.intarnaBin)
+        if getattr(args, "cache", None) is not None: # optional ResultCache for IntaRNA outputs
+            self.useCache(args.cache)
+
+    @classmethod
+    def fromSequences(cls, query, target, params):
+        '''
+            Creates the handler of one query/target pair without a command line.
+            Handlers only read their state, so the handlers of many genomes can
+            share one MRRIParameters and run in different threads.
+
+            query (str): Query sequence (3' side)
+            target (str): Target sequence (5' side)
+            params (MRRIParameters): Shared settings
+        '''
+        return cls(params, query=query, target=target)
+
+    def useCache(self, cache):
+        '''
+            Answer repeated IntaRNA predictions of this handler from the given ResultCache
+        '''
+        self.cache = cache
+        self.backend = CachedBackend(self.backend, cache, self.args.parameterFile)
 
     
     def get_region_of_interest(self, B1, param_mode=1):
@@ -54,20 +104,20 @@ class MRRI():
             params have value of start and end numbers
         
         '''
-        complete = str(self.args.intarnaBin) + ' -q ' + self.querySeq[B1['id2']] + ' -t ' + self.targetSeq[B1['id1']] +' --outMode=C -n 1 '#--energyNoDangles'
+        complete = ['--outMode=C', '-n', '1'] #--energyNoDangles
         # add parameterFile to call if given
         if self.args.parameterFile :
-            complete += " --parameterFile="+self.args.parameterFile
+            complete += ["--parameterFile="+self.args.parameterFile]
         # set require CSV columns
-        complete += " --outCsvCols=id1,start1,end1,id2,start2,end2,subseqDP,hybridDP,E,E_hybrid,ED1,ED2"
+        complete += ["--outCsvCols=id1,start1,end1,id2,start2,end2,subseqDP,hybridDP,E,E_hybrid,ED1,ED2"]
         ########################################
         ############ Hacked in #################
         ########################################
         tidxpos0, qidxpos0, tregion, qregion = self.get_region_of_interest(B1, param_mode)
-        complete += f" --tidxpos0 {str(tidxpos0)} " ## Transition UTR5-CDS
-        complete += f"--qidxpos0 {str(qidxpos0)} "  ## Transition CDS-UTR3
-        complete += f"--tregion {tregion} " ## UTR5start to end+100CDS
-        complete += f"--qregion {qregion} " ## 100CDS to UTR3end ####
+        complete += ["--tidxpos0", str(tidxpos0)] ## Transition UTR5-CDS
+        complete += ["--qidxpos0", str(qidxpos0)]  ## Transition CDS-UTR3
+        complete += ["--tregion", tregion] ## UTR5start to end+100CDS
+        complete += ["--qregion", qregion] ## 100CDS to UTR3end ####
         ########################################
         ########################################
         ########################################
@@ -79,9 +129,17 @@ class MRRI():
             if "tAccConstr" in B1 and B1["tAccConstr"]:
                 result["tAccConstr"] += f",{B1['tAccConstr']}"
                 result["qAccConstr"] += f",{B1['qAccConstr']}"
-            complete += ' --tAccConstr="'+result["tAccConstr"]+'" --qAccConstr="'+result["qAccConstr"]+'" ' ## Add \xa0 before --tAccConst?
-        #print("".join(complete))
-        result.update(self.csv2dict(self.runCmdLine(complete)[0].replace("query",B1['id2']).replace("target",B1['id1'])))
+            complete += ['--tAccConstr='+result["tAccConstr"], '--qAccConstr='+result["qAccConstr"]]
+        # the same set of blocked ranges (in any order) gives the same block again, skip the call
+        key = (B1['id1'], B1['id2'], param_mode, frozenset(result["tAccConstr"].split(",")),
+               frozenset(result["qAccConstr"].split(",")))
+        if key in self.predictions:
+            cached = dict(self.predictions[key])
+            cached.update(tAccConstr=result["tAccConstr"], qAccConstr=result["qAccConstr"])
+            return cached
+        #print(" ".join(complete))
+        result.update(self.csv2dict(self.runBackend(B1, complete)[0].replace("query",B1['id2']).replace("target",B1['id1'])))
+        self.predictions[key] = dict(result)
         ### This might be neccessary? This actually works but something something utf-8.......
         #try:
         #    result.update(self.csv2dict(self.runCmdLine(complete)[0].replace("query",B1['id2']).replace("target",B1['id1'])))
@@ -99,6 +157,54 @@ class MRRI():
         return result
 
 
+    def acceptSite(self, sites, B, max_energy=None, stop_on_overlap=False, stop_on_worse=False):
+        '''
+            Decides if the block B of the next round is a new site or if MRRI has converged
+            sites (list): Blocks accepted so far
+            B (dict): Block returned by runIntaRNA for the last of the sites
+            max_energy (float): Sites with a higher E_hybrid end the search (None: no limit)
+            stop_on_overlap (bool): A site that overlaps an earlier one (or equals it) ends the search.
+                                    Off by default: IntaRNA can place a site around blocked bases
+                                    (e.g. in an interior loop), the pipeline keeps such sites
+            stop_on_worse (bool): A site with a higher E_hybrid than the last one ends the search
+        '''
+        if "id2" not in B: # no further interaction found
+            return False
+        if max_energy is not None and float(B["E_hybrid"]) > max_energy:
+            return False
+        if stop_on_overlap and any(self.sitesOverlap(S, B) for S in sites):
+            return False
+        if stop_on_worse and sites and float(B["E_hybrid"]) > float(sites[-1]["E_hybrid"]):
+            return False
+        return True
+
+    @staticmethod
+    def sitesOverlap(Block1, Block2):
+        '''
+            True if two blocks share a position on the target or on the query
+        '''
+        return ((int(Block1['start1']) <= int(Block2['end1']) and int(Block2['start1']) <= int(Block1['end1'])) or
+                (int(Block1['start2']) <= int(Block2['end2']) and int(Block2['start2']) <= int(Block1['end2'])))
+
+    def runSites(self, param_mode=1, max_k=3, max_energy=None, stop_on_overlap=False, stop_on_worse=False):
+        '''
+            k-site MRRI: predicts one interaction site per round, each round blocks the
+            sites of the earlier rounds, until max_k sites are found or MRRI converged
+            (see acceptSite). Returns the list of sites (empty if there is no interaction).
+            max_k (int): Maximal number of sites (None: until converged)
+        '''
+        qId = next(iter(self.querySeq.keys()))
+        tId = next(iter(self.targetSeq.keys()))
+        sites = []
+        B = dict({ 'id1': tId, 'id2' : qId})
+        while max_k is None or len(sites) < max_k:
+            B = self.runIntaRNA(B, param_mode)
+            if not self.acceptSite(sites, B, max_energy, stop_on_overlap, stop_on_worse):
+                break
+            sites.append(B)
+        return sites
+
+
 ##################################
 ##### Currently unused stuff #####
 ##################################       
@@ -141,33 +247,62 @@ class MRRI():
                     tempDict[seqname] += str(match.group())
             return tempDict
 
-    def getEDunconstraint(self, B1 ):
-        complete = str(self.args.intarnaBin) + ' -q ' + self.querySeq[B1['id2']] + ' -t ' + self.targetSeq[B1['id1']] +' --out=/dev/null -n 0 '#--energyNoDangles'
+    def accessibilityProfiles(self, B1, width=profile_width):
+        '''
+            ED profiles (target, query) of the sequences of B1 for all windows up to width bases
+            (at most the sequence length). Computed by one IntaRNA call on the first lookup and
+            kept for all later ones. In the cache each side is stored on its own, keyed on its
+            sequence and the parameters, so it is reused with any other partner sequence
+        '''
+        sequences = {"target": self.targetSeq[B1['id1']], "query": self.querySeq[B1['id2']]}
+        def usable(side, profile):
+            return profile is not None and profile.width >= min(width, len(sequences[side]))
+        profiles = {side: self.accessibility.get((side, seq)) for side, seq in sequences.items()}
+        if all(usable(side, profile) for side, profile in profiles.items()):
+            return profiles["target"], profiles["query"]
+        complete = ['--out=/dev/null', '-n', '0'] #--energyNoDangles
         # add parameterFile to call if given
         if self.args.parameterFile :
-            complete += " --parameterFile="+self.args.parameterFile
-        # set require ED output
-        complete += " --out=tAcc:STDOUT --out=qAcc:STDERR"
-        # confine output to region of interest
-        l1 = int(B1['end1'])-int(B1['start1'])+1
-        l2 = int(B1['end2'])-int(B1['start2'])+1
-        complete += " --tIntLenMax=" + str(l1) + " --qIntLenMax=" +str(l2)
-        # run intarna
-        outputED = self.runCmdLine( complete )
-        # parse ED1 from stdout == outputED[0]
-        # TODO CRASHES IF (tIdxPos0 != 1)
-        ED1 = round(float(outputED[0].split('\n')[ int(B1['end1'])+1 ].split()[l1]),2)
-        # parse ED2 from stdout == outputED[1]
-        ED2 = round(float(outputED[1].split('\n')[ int(B1['end2'])+1 ].split()[l2]),2)
-        # return combined constraints
+            complete += ["--parameterFile="+self.args.parameterFile]
+        # set require ED output, numbered from 1 so rows are sequence positions
+        complete += ["--out=tAcc:STDOUT", "--out=qAcc:STDERR"]
+        complete += ["--tIntLenMax=" + str(max(width, profile_width)), "--qIntLenMax=" +str(max(width, profile_width))]
+        complete += ["--tidxpos0", "1", "--qidxpos0", "1"]
+        # the profiles are cached instead of the text output of IntaRNA
+        backend = self.backend.backend if isinstance(self.backend, CachedBackend) else self.backend
+        keys = {}
+        if self.cache is not None:
+            parameters = parameter_file_content(self.args.parameterFile)
+            for side, seq in sequences.items():
+                keys[side] = self.cache.key("IntaRNA ED", side, backend.version(), parameters, seq)
+                if not usable(side, profiles[side]):
+                    cached = self.cache.get(keys[side])
+                    profiles[side] = profile_from_bytes(cached) if cached is not None else None
+        if not all(usable(side, profile) for side, profile in profiles.items()):
+            outputED = backend.run(sequences["query"], sequences["target"], complete)
+            # tAcc on stdout == outputED[0], qAcc on stderr == outputED[1]
+            profiles = {"target": parse_accessibility(outputED[0]), "query": parse_accessibility(outputED[1])}
+            for side, key in keys.items():
+                self.cache.put(key, profile_to_bytes(profiles[side]))
+        for side, seq in sequences.items():
+            self.accessibility[(side, seq)] = profiles[side]
+        return profiles["target"], profiles["query"]
+
+    def getEDunconstraint(self, B1 ):
+        '''
+            Unconstrained ED of both sites of B1, looked up in the accessibility profiles.
+            The positions of B1 are numbered like in runIntaRNA (see get_region_of_interest)
+        '''
+        tidxpos0, qidxpos0, _, _ = self.get_region_of_interest(B1)
+        start1, end1 = index_to_position(B1['start1'], tidxpos0), index_to_position(B1['end1'], tidxpos0)
+        start2, end2 = index_to_position(B1['start2'], qidxpos0), index_to_position(B1['end2'], qidxpos0)
+        tAcc, qAcc = self.accessibilityProfiles(B1, max(end1-start1, end2-start2)+1)
+        ED1 = round(float(tAcc.ed(start1, end1)),2)
+        ED2 = round(float(qAcc.ed(start2, end2)),2)
         return [ED1,ED2]
 
-    def runCmdLine(self,completeCall):
-        #print(completeCall)
-        ps = s.Popen(str(completeCall),  stdout = s.PIPE, stderr=s.PIPE, universal_newlines=True, shell=True)
-        (stdout, stderr) = ps.communicate()
-        if ps.returncode:  # If IntaRNA exits with a returncode != 0, skip this iteration
-            sys.stderr.write("IntaRNA failed ({}) for call {}\n".format(stderr,completeCall))
-            #exit(ps.returncode)
-            return None
-        return [stdout,stderr]
+    def runBackend(self, B1, arguments):
+        '''
+            Run IntaRNA via self.backend on the sequences of B1 with the given further arguments
+        '''
+        return self.backend.run(self.querySeq[B1['id2']], self.targetSeq[B1['id1']], arguments)
@@ -2,9 +2,9 @@ import os
 import sys
 import argparse
 import json
-from Codes.MRRI import MRRI
+from Codes.MRRI import MRRI, MRRIParameters
 #try:
-#    from Codes.MRRI import MRRI
+#    from Codes.MRRI import MRRI, MRRIParameters
 #except:
 #    from MRRI import MRRI
 import re, csv
@@ -43,7 +43,8 @@ def createMRRI(args):
     args.intarnaBin = "IntaRNA" ####
     IntaRNA = {"exists": True}  #### findBinary(args.intarnaBin) ####
     if IntaRNA.get("exists") == True:
-        MRRI_instance = MRRI(args)
+        params = MRRIParameters(args.parameterFile, args.intarnaBin)
+        MRRI_instance = MRRI.fromSequences(args.query, args.target, params)
         return MRRI_instance
     else:
         sys.exit(-1)
@@ -99,51 +100,12 @@ def sameBlock( Block1, Block2 ):
     #print(B2)
     #B2['start1'] == B2['end1'] == B2['start2'] == B2['end2'] == B3['start1'] == B3['start2'] == B3['end1'] == B3['end2']
     result = all( Block1[k]==Block2[k] for k in ('start1', 'end1', 'start2', 'end2'))
-    print(result)
+    return result
 
 
 if __name__ == '__main__':
     MRRIHandler = main()
-    for qId in MRRIHandler.querySeq.keys():
-        for tId in MRRIHandler.targetSeq.keys():
-            B2 = dict({ 'id1': tId, 'id2' : qId})
-            B1 = MRRIHandler.runIntaRNA(B2)
-            B2 = None
-            B3 = None
-            ##print(B1) ### v1: Only 1 Round (like normal IntaRNA
-            ##break
-            #csvHeader(B1) ### These lines are only printing stuff and are useless
-            iteration = 1
-            E2 = 999 ###
-            #E = 0    ###
-            while True:
-                #if iteration % 2 == 1:
-                #    E = printCSVRow(B1, B2, MRRIHandler)
-                #else:
-                #    E = printCSVRow(B2, B1, MRRIHandler)
-                B3 = MRRIHandler.runIntaRNA(B1)
-                ####E = round(float(B1['E']) + float(B2['E']),2)
-                #if(B2 != None and len(B1["hybridDP"]) >= len(B3["hybridDP"])):
-                if(float(B1["E_hybrid"]) < float(B3["E_hybrid"])): 
-                #if(float(B1["E"]) < float(B3["E"])):  ### v2: Directly compare energies
-                #if E2 <= E: ### v3: Compare new energies # E2: Energy of B1, E: energy of B1
-                #if( B2 == B3): ### v0: Currently doesnt work?
-                    #sameBlock(B2, B3)
-                    print(B1)
-                    break
-                else:
-                    B2 = B1
-                    B1 = B3
-                    #E2 = E
-                    #print(B1)
-                iteration +=  1
-
-                
-
-
-
-
-    
-
-
-   
+    ## Add sites until E_hybrid gets worse or a site overlaps an earlier one, then print the last site before that
+    sites = MRRIHandler.runSites(max_k=None, stop_on_worse=True, stop_on_overlap=True)
+    if sites:
+        print(sites[-1])
@@ -0,0 +1,75 @@
+import io
+import numpy as np
+
+
+## Largest window of a profile computed by default (IntaRNA's default intLenMax),
+## profiles are recomputed wider if a lookup needs more
+profile_width = 60
+
+
+def index_to_position(index, idxpos0):
+    """0-based sequence position of an IntaRNA index.
+    IntaRNA numbers the first base with idxpos0 and skips the index 0
+    if idxpos0 is negative (..., -2, -1, 1, 2, ...).
+
+    index (int/str): Index as written by IntaRNA (e.g. start1)
+    idxpos0 (int): Index of the first base (--tIdxPos0/--qIdxPos0 of the call)
+    """
+    index = int(index)
+    if idxpos0 < 0 and index > 0:
+        return index - idxpos0 - 1
+    return index - idxpos0
+
+
+class AccessibilityProfile():
+    """
+    ED values of all windows of one sequence up to a maximal length,
+    as written by IntaRNA with --out=tAcc/--out=qAcc (RNAplfold format).
+    Row i holds the windows ending at the 0-based position i, column l-1
+    the window of length l, so every lookup is a single array access.
+    """
+
+    def __init__(self, ed):
+        """
+        ed (np.array): n x width matrix of ED values (nan where IntaRNA wrote NA)
+        """
+        self.values = ed
+
+    @property
+    def width(self):
+        """Length of the longest window in the profile."""
+        return self.values.shape[1]
+
+    def ed(self, start, end):
+        """ED of the window of 0-based positions start..end (both included)."""
+        return self.values[end, end - start]
+
+
+def parse_accessibility(text):
+    """Parses the ED matrix of IntaRNA --out=tAcc/--out=qAcc into an AccessibilityProfile.
+    Rows are taken by their position label, the header lines (#) are skipped.
+
+    text (str): Output of IntaRNA
+    """
+    rows = {}
+    for line in text.split("\n"):
+        split_line = line.split()
+        if not split_line or split_line[0].startswith("#"):
+            continue
+        rows[int(split_line[0])] = [np.nan if value == "NA" else float(value) for value in split_line[1:]]
+    ed = np.full((max(rows, default=0), max(map(len, rows.values()), default=0)), np.nan)
+    for label, row in rows.items():
+        ed[label-1, :len(row)] = row
+    return AccessibilityProfile(ed)
+
+
+def profile_to_bytes(profile):
+    """Compressed npz of the profile of one sequence (for a ResultCache)."""
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, ed=profile.values)
+    return buffer.getvalue()
+
+
+def profile_from_bytes(data):
+    """Inverse of profile_to_bytes."""
+    return AccessibilityProfile(np.load(io.BytesIO(data))["ed"])
@@ -0,0 +1,107 @@
+import os
+import functools
+import numpy as np
+
+
+gap_chars = "-.~"
+_gap_table = np.zeros(256, dtype=bool)
+_gap_table[[ord(c) for c in gap_chars]] = True
+
+
+class Alignment():
+    """
+    Multiple alignment (Stockholm or CLUSTAL) parsed once.
+    Rows are indexed by name, residue columns of a row are computed once,
+    so per-residue values can be spread into the alignment columns without
+    scanning the alignment again.
+    """
+
+    def __init__(self, rows, gs={}, gc={}, annotations={}):
+        """
+        rows (dict): Name => aligned sequence (all blocks joined)
+        gs (dict): Name => {feature: text} of the #=GS lines (Stockholm)
+        gc (dict): Feature => column annotation of the #=GC lines, e.g. SS_cons
+        annotations (dict): Other name => row lines like the anchors "#A1" of locARNA
+        """
+        self.rows = rows
+        self.gs = gs
+        self.gc = gc
+        self.annotations = annotations
+        self._residues = {}
+        self._descriptions = None
+
+    def residue_columns(self, name):
+        """Alignment columns of the residues of a row (array, ascending)."""
+        if name not in self._residues:
+            row = np.frombuffer(self.rows[name].encode("utf-8"), dtype=np.uint8)
+            self._residues[name] = np.flatnonzero(~_gap_table[row])
+        return self._residues[name]
+
+    def ungapped(self, name):
+        """Sequence of a row without gaps."""
+        row = self.rows[name]
+        return "".join(row[i] for i in self.residue_columns(name))
+
+    def spread(self, name, values, filler):
+        """Writes one character per residue of a row into its alignment columns,
+        the gap columns get the filler.
+
+        values (str): One character per residue of the row
+        filler (str): Character for the gap columns
+        """
+        result = np.full(len(self.rows[name]), ord(filler), dtype=np.uint8)
+        result[self.residue_columns(name)] = np.frombuffer(values.encode("utf-8"), dtype=np.uint8)
+        return result.tobytes().decode("utf-8")
+
+    def name_by_description(self, accession):
+        """Name of the row whose #=GS DE starts with the accession (cmsearch alignments), or None."""
+        if self._descriptions is None:
+            self._descriptions = {}
+            for name, features in self.gs.items():
+                if features.get("DE"):
+                    self._descriptions.setdefault(features["DE"].split()[0], name)
+        return self._descriptions.get(accession)
+
+
+def parse_alignment(lines):
+    """Parses the lines of a Stockholm or CLUSTAL alignment into an Alignment.
+    Only the first alignment of a Stockholm file is read.
+    """
+    rows, gs, gc, annotations = {}, {}, {}, {}
+    for line in lines:
+        if line.startswith("//"):
+            break
+        split_line = line.split()
+        if not split_line or line.startswith("CLUSTAL") or line.startswith("# STOCKHOLM"):
+            continue
+        if line.startswith("#=GS") and len(split_line) >= 3:
+            gs.setdefault(split_line[1], {})[split_line[2]] = line.split(None, 3)[3].rstrip("\n") if len(split_line) > 3 else ""
+        elif line.startswith("#=GC") and len(split_line) >= 3:
+            gc[split_line[1]] = gc.get(split_line[1], "") + split_line[-1]
+        elif line.startswith("#=") or line.startswith(" "):
+            continue  ## Other Stockholm markup and CLUSTAL conservation lines
+        elif line.startswith("#"):
+            if len(split_line) >= 2:
+                annotations[split_line[0]] = annotations.get(split_line[0], "") + split_line[-1]
+        elif len(split_line) == 2:
+            rows[split_line[0]] = rows.get(split_line[0], "") + split_line[1]
+    return Alignment(rows, gs, gc, annotations)
+
+
+## Number of parsed alignment files kept in memory by load_alignment
+max_cached_alignments = 64
+
+
+@functools.lru_cache(maxsize=max_cached_alignments)
+def _read_alignment(path, mtime_ns, size):
+    """Parses an alignment file, mtime_ns and size only key the cache."""
+    with open(path, "r") as f:
+        return parse_alignment(f)
+
+
+def load_alignment(path):
+    """Returns the Alignment of a file, parsed only once as long as the file does not change
+    (the last max_cached_alignments files are kept).
+    """
+    stat = os.stat(path)
+    return _read_alignment(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
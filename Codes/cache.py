@@ -0,0 +1,166 @@
+import os
+import io
+import time
+import hashlib
+import subprocess
+import threading
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def intarna_version(intarna_bin="IntaRNA"):
+    """Returns the version string of the given IntaRNA binary.
+    Part of every cache key, so updating IntaRNA invalidates old results.
+
+    intarna_bin (str): Name or path of the IntaRNA binary
+    """
+    try:
+        p = subprocess.run([str(intarna_bin), "--version"],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return ""
+    return p.stdout.decode("utf-8").strip()
+
+
+def file_content(path):
+    """Returns the content of a file as bytes or b"" if there is no such file.
+
+    path (str): Filepath (e.g. the static parameter file)
+    """
+    if not path or not os.path.isfile(path):
+        return b""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def parameter_file_content(path):
+    """Returns the content of an IntaRNA parameter file together with the contents
+    of the files it references (e.g. energyVRNA = Data/rna_andronescu2007.par),
+    so that editing a referenced file also changes the cache key.
+    References are resolved like IntaRNA does (working directory), and
+    relative to the parameter file as a fallback.
+
+    path (str): Filepath of the parameter file
+    """
+    content = file_content(path)
+    parts = [content]
+    for line in content.decode("utf-8", errors="replace").splitlines():
+        if "=" not in line or line.lstrip().startswith("#"):
+            continue
+        value = line.split("=", 1)[1].strip()
+        for candidate in (value, os.path.join(os.path.dirname(path), value)):
+            if value and os.path.isfile(candidate):
+                parts.append(value.encode("utf-8") + b"\0" + file_content(candidate))
+                break
+    return b"\0".join(parts)
+
+
+class CachedProcess():
+    """Stand-in for a finished subprocess whose stdout was taken from the cache.
+    Offers the parts of subprocess.Popen used by read_output.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = io.BytesIO(stdout)
+        self.returncode = 0
+
+    def wait(self):
+        return self.returncode
+
+
+class ResultCache():
+    """Content-addressed on-disk cache for outputs of external tools.
+
+    Entries are files named by the SHA-256 hash of everything that
+    influences the result (sequences, arguments, parameter files, versions).
+    If the cache grows above max_bytes, the least recently used entries are
+    removed until it is below low_water*max_bytes, so eviction is rare.
+    Sizes and access times are kept in an index that is read from disk once.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024**3, low_water=0.9):
+        """
+        cache_dir (str): Directory of the cache, created if needed
+        max_bytes (int): Size limit of all cache entries together
+        low_water (float): Fraction of max_bytes the cache is reduced to when it is full
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.index = None  ## path => [size, access time] of all entries, read on first put
+        self.size = 0  ## Total size of all entries in the index
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, *parts):
+        """Hashes the given parts (str, bytes or anything with a str()) into a key."""
+        h = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = str(part).encode("utf-8")
+            h.update(str(len(part)).encode("utf-8") + b":")  ## Keeps ("ab","c") != ("a","bc")
+            h.update(part)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return f"{self.cache_dir}/{key[:2]}/{key}"
+
+    def get(self, key):
+        """Returns the cached bytes for a key or None if there is no entry."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  ## Mark as recently used
+        except FileNotFoundError:
+            return data  ## Evicted in the meantime
+        with self.lock:
+            if self.index is not None and path in self.index:
+                self.index[path][1] = time.time()
+        return data
+
+    def put(self, key, data):
+        """Stores bytes (or str) under a key and evicts old entries if necessary."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self.lock:
+            os.replace(tmp_path, path)  ## Readers never see half written entries
+            if self.index is None:
+                self.index = {entry: [size, mtime] for entry, size, mtime in self._entries()}
+                self.size = sum(size for size, _ in self.index.values())
+            else:
+                old_size = self.index.get(path, [0])[0]
+                self.index[path] = [len(data), time.time()]
+                self.size += len(data) - old_size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".tmp"):
+                    continue
+                stat = os.stat(f"{root}/{file}")
+                yield f"{root}/{file}", stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """Removes least recently used entries of the index until the cache is below
+        low_water*max_bytes. Called with the lock held."""
+        target = self.low_water * self.max_bytes
+        for path, (size, _) in sorted(self.index.items(), key=lambda entry: entry[1][1]):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  ## Removed by another process
+            del self.index[path]
+            self.size -= size
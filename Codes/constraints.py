@@ -0,0 +1,147 @@
+import sys
+import ast
+import time
+import string
+import pandas as pd
+from Codes.locarna_help import find_all, integrate_into
+
+
+def interactions_into(buffer, ranges, pad, letters):
+    """Writes the letters of all interactions into a constraint buffer in place.
+    Same result as integrate_into(s, "."*(start+pad) + hybridDP, letter) for
+    every interaction, positions behind the end are appended like there.
+
+    buffer (bytearray): Constraint, changed in place
+    ranges (list): Interactions (start, end, energy, hybridDP)
+    pad (int): Offset of the interaction starts in the buffer
+    letters (str): Letter of the i-th interaction
+    """
+    for i, interaction in enumerate(ranges):
+        letter = letters[i]
+        code = ord(letter)
+        offset = max(0, int(interaction[0]) + pad)
+        for pos in find_all(interaction[3], letter):
+            pos += offset
+            if pos < len(buffer):
+                buffer[pos] = code
+            else:
+                buffer.append(code)
+    return buffer
+
+
+def nested_interaction_constraint(cons_FS):
+    """#FS constraint of mode 3: A/a and B/b become brackets, C/c only if nested with A and B."""
+    cons_S = str(cons_FS)
+    first_A = cons_S.find("A")
+    first_B = cons_S.find("B")
+    first_C = cons_S.find("C")
+    first_a = cons_S.find("a")
+    first_b = cons_S.find("b")
+    first_c = cons_S.find("c")
+    cons_S = cons_S.replace("A", "(").replace("a", ")").replace("B", "(").replace("b", ")")
+    if ((first_C < first_A and first_C < first_B and first_c > first_a and first_c > first_b) or # CAB bac and CBA abc
+       (first_C < first_A and first_C > first_B and first_c > first_a and first_c < first_b) or  # BCA acb
+       (first_C > first_A and first_C < first_B and first_c < first_a and first_c > first_b) or  # ACB bca
+       (first_C > first_A and first_C > first_B and first_c < first_a and first_c < first_b)):   # ABC cba and BAC cab
+        cons_S = cons_S.replace("C", "(").replace("c", ")")
+    else: # C is not nested with A and B so it gets ignored
+        cons_S = cons_S.replace("C", ".").replace("c", ".")
+    return cons_S
+
+
+def build_constraints(seq5, seq3, ranges_t, ranges_q, CDS_start, CDS_left, CDS_right,
+                      cm_hit_f, cm_hit_t, mode=1):
+    """Builds all locARNA constraints of one genome.
+
+    seq5 (str): 5' sequence (with extra bases)
+    seq3 (str): 3' sequence (with extra bases)
+    ranges_t (list): 5' side interactions (start, end, energy, hybridDP)
+    ranges_q (list): 3' side interactions
+    CDS_start (int): Start of the CDS in seq5 (UTR5len)
+    CDS_left (int): Bases left of the CDS start that are kept
+    CDS_right (int): Bases right of the CDS start that are kept
+    cm_hit_f (int): Start of the CM hit (only used in mode 2)
+    cm_hit_t (int): End of the CM hit (only used in mode 2)
+    mode (int): Mode of the #S constraint (see run_rnaalifold)
+
+    Output:
+    part5 (str), part3 (str): Cut sequences
+    cons_S (str), cons_1 (str), cons_2 (str), cons_FS (str): Constraints. In mode 3 cons_FS
+                  still has to be completed by get_special_combined_constraints.
+    """
+    ## How much to cut of from the 5' and 3' sequences and their constraints
+    cutoff_5_left = CDS_start-CDS_left
+    cutoff_5_right = CDS_start+CDS_right
+    cutoff_3_left = len(seq3)-141
+    cutoff_3_right = None ##### Old: len(seq3)-49
+
+    ## Cut sequences:
+    part5 = seq5[cutoff_5_left:cutoff_5_right]
+    part3 = seq3[cutoff_3_left:cutoff_3_right]
+
+    ## #FS Constraints:
+    cons_FS_5 = interactions_into(bytearray(b"."*(len(seq5)-100)), ranges_t, len(seq5)-200, string.ascii_uppercase)
+    cons_FS_3 = interactions_into(bytearray(b"."*(len(seq3))), ranges_q, 199, string.ascii_lowercase)
+    cons_FS = (cons_FS_5[cutoff_5_left:cutoff_5_right] + b"xxxxxxx" +
+               cons_FS_3[cutoff_3_left:cutoff_3_right]).decode("ascii")
+
+    ## #S constraint:
+    if mode == 0:   ## None:    .......xxxxxxx.......
+        cons_S = f"{'.'*len(part5)}xxxxxxx{'.'*len(part3)}"
+    elif mode == 1: ## Classic: <<<<<<<xxxxxxx>>>>>>>
+        cons_S = f"{'<'*len(part5)}xxxxxxx{'>'*len(part3)}"
+    elif mode == 2: ## everything blocked ("x"), except where the cmhit is (there ".")
+        covar_3SL = "x"*(cm_hit_f+199) + "."*(cm_hit_t - cm_hit_f + 1)
+        covar_3SL += "x"*max(0, len(seq3) - len(covar_3SL)) ## Extend remaining dots
+        covar_3SL = covar_3SL[:len(seq3)] ## One specific sequence has cm_t LARGER than the sequence itself so..
+        covar_3SL = covar_3SL[cutoff_3_left:cutoff_3_right]
+        cons_S = f"{(len(part5))*'x'}xxxxxxx{covar_3SL}"
+    elif mode == 3: ## #S constraint using interactions (using the #FS sequence)
+        cons_FS = nested_interaction_constraint(cons_FS)
+        cons_S = f"{'.'*len(part5)}xxxxxxx{'.'*len(part3)}"
+    else:
+        raise ValueError("Invalid mode for #S constraint")
+    ## Constraint 1/2:
+    cons_1 = f"{CDS_left*'.'}AAA{(CDS_right-3)*'.'}BBBBBBB{len(part3)*'.'}"
+    cons_2 = f"{CDS_left*'.'}123{(CDS_right-3)*'.'}1234567{len(part3)*'.'}"
+    return part5, part3, cons_S, cons_1, cons_2, cons_FS
+
+
+def fs_constraint_by_slicing(seq5, seq3, ranges_t, ranges_q, CDS_start, CDS_left, CDS_right):
+    """#FS constraint built with integrate_into, for benchmark_constraints."""
+    cons_FS_5 = "."*(len(seq5)-100)
+    cons_FS_3 = "."*(len(seq3))
+    for i in range(len(ranges_t)):
+        cons_FS_5 = integrate_into(cons_FS_5, "."*(int(ranges_t[i][0])+len(seq5)-200) + ranges_t[i][3], string.ascii_uppercase[i])
+    for i in range(len(ranges_q)):
+        cons_FS_3 = integrate_into(cons_FS_3, "."*(int(ranges_q[i][0])+199) + ranges_q[i][3], string.ascii_lowercase[i])
+    return cons_FS_5[CDS_start-CDS_left:CDS_start+CDS_right] + "xxxxxxx" + cons_FS_3[len(seq3)-141:]
+
+
+def benchmark_constraints(input_df_file_path, CDS_left=40, CDS_right=70, repeats=20):
+    """Times the #FS constraints of all genomes of a prediction table
+    with integrate_into and with build_constraints, and checks that both agree.
+
+    input_df_file_path (str): Table with seq5, seq3, UTR5len, predictions_t and predictions_q
+    repeats (int): Number of passes over the table per variant
+    """
+    df = pd.read_csv(input_df_file_path)
+    genomes = [(row.seq5, row.seq3, ast.literal_eval(row.predictions_t), ast.literal_eval(row.predictions_q),
+                row.UTR5len) for row in df.itertuples()]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        old = [fs_constraint_by_slicing(s5, s3, t, q, c, CDS_left, CDS_right) for s5, s3, t, q, c in genomes]
+    time_old = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        new = [build_constraints(s5, s3, t, q, c, CDS_left, CDS_right, 0, 0, mode=0)[5] for s5, s3, t, q, c in genomes]
+    time_new = time.perf_counter() - start
+    assert old == new, "build_constraints differs from integrate_into"
+    n = len(genomes) * repeats
+    print(f"integrate_into:    {time_old/n*1e6:.1f} us per genome")
+    print(f"build_constraints: {time_new/n*1e6:.1f} us per genome (incl. #S, #1, #2)")
+    return time_old, time_new
+
+
+if __name__ == "__main__":
+    benchmark_constraints(sys.argv[1] if len(sys.argv) > 1 else "Results/MRRI_output_2.csv")
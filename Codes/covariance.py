@@ -1,7 +1,11 @@
 import subprocess
 import os
 import re
+import threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Codes.parameters import file_hash
+from Codes.tools import tool_cmd
 
 
 def run_cmbuild(input_stk, output_cm):
@@ -11,43 +15,112 @@ def run_cmbuild(input_stk, output_cm):
     output_cm (str): Filepath of the resulting CM file
     """
     print(f"cmbuild: {input_stk} `=> {output_cm}")
-    cmd = ["cmbuild", output_cm, input_stk]
+    cmd = tool_cmd("cmbuild") + ["-F", output_cm, input_stk] # -F: Rebuild models of changed alignments
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    p.wait()
+    p.communicate()
+    return p
 
     
-def calibrate_cm(cm):
+def calibrate_cm(cm, cpu=None, mpi=False):
     """Calibrate the created covariance model.
     Takes a long time and is expensive on CPU.
     
     cm (str): Filepath of the CM file to be calibrated
+    cpu (int): Number of worker threads (--cpu), or of MPI processes if mpi is True
+    mpi (bool): If True, runs cmcalibrate --mpi under mpirun (Infernal built with MPI)
     """
-    cmd = ["cmcalibrate", cm]
+    if mpi:
+        cmd = ["mpirun", "-np", str(cpu or 1)] + tool_cmd("cmcalibrate") + ["--mpi", cm]
+    else:
+        cmd = tool_cmd("cmcalibrate") + ([cm] if cpu is None else ["--cpu", str(cpu), cm])
     p = subprocess.Popen(cmd)
     p.wait()
+    return p
 
   
-def create_cms(stk_dir, out_cm_dir, calibrate=True):
+def read_cm_manifest(manifest_path):
+    """Reads the checkpoint written by create_cms.
+
+    Output:
+    manifest (dict): cm file => (stockholm file, hash, calibrated)
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    manifest = pd.read_csv(manifest_path, dtype={"hash": str})
+    return {row.cm: (row.stockholm, row.hash, bool(row.calibrated))
+            for row in manifest.itertuples()}
+
+
+def write_cm_manifest(manifest, manifest_path):
+    columns = ["stockholm", "hash", "calibrated"]
+    df = pd.DataFrame.from_dict(manifest, orient="index", columns=columns)
+    df.to_csv(f"{manifest_path}.tmp", index_label="cm")
+    os.replace(f"{manifest_path}.tmp", manifest_path) # An interrupted run never leaves half a checkpoint
+
+
+def build_cm(stk_file, cmfile_path, digest, calibrate, cpu, mpi):
+    """Builds and optionally calibrates one model.
+
+    Output:
+    entry (tuple): Manifest entry (stockholm file, hash, calibrated) or None if a step failed
+    """
+    if run_cmbuild(stk_file, cmfile_path).returncode:
+        print(f"cmbuild failed for {stk_file}")
+        return None
+    if calibrate and calibrate_cm(cmfile_path, cpu=cpu, mpi=mpi).returncode:
+        print(f"cmcalibrate failed for {cmfile_path}")
+        return None
+    return (stk_file, digest, calibrate)
+
+
+def create_cms(stk_dir, out_cm_dir, calibrate=True, jobs=1, mpi=False):
     """Creates a directory of covariance models out of a given directory of
     stockholm files and calibrates them afterwards.
     Warning: Calibrating is slow and expensive.
+    Every model is built and calibrated as its own job. Finished models are
+    recorded with the hash of their stockholm file in {out_cm_dir}.manifest,
+    models whose stockholm file did not change are skipped. So an interrupted
+    run resumes and a new alignment only (re)calibrates its own model.
     
     stk_dir (str): Filepath to the directory of stockholm files.
     out_cm_dir (str): Filepath for the directory of finished cm files
     calibrate (bool): If True, calibrates cmfiles after creating them
+    jobs (int): Number of CPUs shared by all models (via --cpu or MPI processes)
+    mpi (bool): If True, calibrates with cmcalibrate --mpi (see calibrate_cm)
     """
     os.makedirs(out_cm_dir, exist_ok=True)
+    manifest_path = f"{out_cm_dir.rstrip('/')}.manifest"
+    manifest = read_cm_manifest(manifest_path)
     expression = re.compile(".*3SL.*")
+    todo = []
     for root, dirs, files in os.walk(stk_dir):
         for file in files:
             if expression.match(file):
                 cmfile_path = f"{out_cm_dir}/{file.split('.')[0]}_3SL.cm"
-                run_cmbuild(f"{root}/{file}", cmfile_path)
-                if calibrate:
-                    calibrate_cm(cmfile_path)
+                digest = file_hash(f"{root}/{file}")
+                entry = manifest.get(cmfile_path)
+                if (entry and entry[1] == digest and (entry[2] or not calibrate)
+                        and os.path.isfile(cmfile_path)):
+                    continue # Unchanged since the last run
+                todo.append((f"{root}/{file}", cmfile_path, digest))
+    if not todo:
+        return
+    workers = max(1, min(jobs, len(todo)))
+    cpu = max(1, jobs // workers)  ## --cpu share, so that workers * cpu <= jobs
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_cm, stk_file, cmfile_path, digest, calibrate, cpu, mpi): cmfile_path
+                   for stk_file, cmfile_path, digest in todo}
+        for future in as_completed(futures):
+            entry = future.result()
+            if entry is None:
+                continue
+            with lock:
+                manifest[futures[future]] = entry
+                write_cm_manifest(manifest, manifest_path) # Checkpoint after every model
 
 
-def run_cm_search(cm_file, seq_file, output, output_alignment):
+def run_cm_search(cm_file, seq_file, output, output_alignment, cpu=None):
     """
     Runs cm_search with the given files.
     Should look like:
@@ -58,15 +131,198 @@ def run_cm_search(cm_file, seq_file, output, output_alignment):
     seq_file (str): Filepath for Sequence file 
     output (str): Filepath of the resulting output table
     output_alignment (str): Filepath to the alignment file of cm_search
+    cpu (int): Number of worker threads of cmsearch (--cpu), None for its default
     """
-    cmd = ["cmsearch", "--tblout", output, "-A", output_alignment, "--toponly", cm_file, seq_file]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    cmd = tool_cmd("cmsearch") + ["--tblout", output, "-A", output_alignment, "--toponly"]
+    if cpu is not None:
+        cmd += ["--cpu", str(cpu)]
+    cmd += [cm_file, seq_file]
+    ## The results are read from --tblout and -A, a piped stdout could fill up and block cmsearch
+    p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
     p.wait()
     return p
     
-def cm_search(df, cm_dir, seq_dir, output_path, output_file):
+def read_tblout(tblout_file):
+    """Reads a cmsearch --tblout file into a table of hits.
+
+    tblout_file (str): Filepath of the --tblout output
+
+    Output:
+    hits (df): One row per hit with the columns
+               id (first word of the target description), cm_hit_f, cm_hit_t, score
+    """
+    ids, starts, ends, scores = [], [], [], []
+    with open(tblout_file, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            split_line = line.split()
+            ids.append(split_line[17])
+            starts.append(int(split_line[7]))
+            ends.append(int(split_line[8]))
+            scores.append(float(split_line[14]))
+    return pd.DataFrame({"id": ids, "cm_hit_f": starts, "cm_hit_t": ends, "score": scores})
+
+
+def read_ss_cons(alignment_file):
+    """Returns the (last) #=GC SS_cons line of a Stockholm alignment."""
+    align_cons = None
+    with open(alignment_file, "r") as f:
+        for line in f:
+            if line.startswith("#=GC SS_cons"):
+                align_cons = line.split()[-1]
+    return align_cons
+
+
+def best_cm_hits(hits):
+    """Picks the best scoring hit of every id.
+    Ties go to the earlier hit, hits of later sequence files replace earlier ones.
+
+    hits (df): Hits of all searches with the columns of read_tblout plus
+               seq_file_index, cm_index, cm_hit_src and align_cons_3SL
+
+    Output:
+    best (df): Best hit per id, indexed by id
+    """
+    hits = hits.sort_values(["seq_file_index", "cm_index"], kind="stable").reset_index(drop=True)
+    best = hits.loc[hits.groupby(["seq_file_index", "id"], sort=False)["score"].idxmax()]
+    best = best.sort_values("seq_file_index", kind="stable").drop_duplicates("id", keep="last")
+    return best.set_index("id")
+
+
+def merge_cm_hits(df, best):
+    """Writes the best CM hits into the IntaRNA dataframe in one join on the id.
+
+    df (df): Dataframe with an id column
+    best (df): Best hits as returned by best_cm_hits
+    """
+    has_hit = df["id"].isin(best.index)
+    for column in ("cm_hit_f", "cm_hit_t", "cm_hit_src", "align_cons_3SL"):
+        values = df["id"].map(best[column])
+        if column in ("cm_hit_f", "cm_hit_t"):
+            values = values.astype(float)
+        if column in df:
+            values = values.where(has_hit, df[column])
+        df[column] = values
+    return df
+
+
+def cm_search_job(cm_path, seq_path, out_file, out_align_file, cpu, seq_file_index, cm_index, cm_file):
+    """Runs one cmsearch of the (CM x sequence file) grid and reads its hits.
+
+    Output:
+    hits (df): Hits of read_tblout with the columns needed by best_cm_hits
+    """
+    run_cm_search(cm_path, seq_path, out_file, out_align_file, cpu=cpu)
+    hits = read_tblout(out_file)
+    hits["seq_file_index"] = seq_file_index
+    hits["cm_index"] = cm_index
+    hits["cm_hit_src"] = cm_file
+    hits["align_cons_3SL"] = read_ss_cons(out_align_file)
+    return hits
+
+
+def read_cm_name(cm_file):
+    """Returns the NAME of the (first) model in a CM file, as used in the cmsearch outputs."""
+    with open(cm_file, "r") as f:
+        for line in f:
+            if line.startswith("NAME"):
+                return line.split()[1]
+    return None
+
+
+def concatenate_cms(cm_paths, output_cm):
+    """Writes all given CM files into one model database, so a single
+    cmsearch run searches all of them. cmsearch still scans the sequence
+    file once per model, this only saves starting one process per model.
+
+    cm_paths (list): Filepaths of the CM files, in search order
+    output_cm (str): Filepath of the combined CM file
+    """
+    with open(f"{output_cm}.tmp", "wb") as out:
+        for cm_path in cm_paths:
+            with open(cm_path, "rb") as f:
+                out.write(f.read())
+    os.replace(f"{output_cm}.tmp", output_cm)
+
+
+def stream_tblout(tblout_file):
+    """Generator over the hits of a --tblout file of a (multi model) cmsearch.
+
+    Output:
+    hits (tuple): (model name, target name/from-to, id, from, to, score) for every hit
+    """
+    with open(tblout_file, "r") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            split_line = line.split()
+            yield (split_line[2], f"{split_line[0]}/{split_line[7]}-{split_line[8]}",
+                   split_line[17], int(split_line[7]), int(split_line[8]), float(split_line[14]))
+
+
+def stream_stockholm(alignment_file):
+    """Generator over the alignments of a (multi model) cmsearch -A file.
+
+    Output:
+    alignments (tuple): (set of sequence names "name/from-to", SS_cons) for every alignment
+    """
+    names, ss_cons = set(), ""
+    with open(alignment_file, "r") as f:
+        for line in f:
+            if line.startswith("//"):
+                yield names, ss_cons
+                names, ss_cons = set(), ""
+            elif line.startswith("#=GC SS_cons"):
+                ss_cons += line.split()[-1]  ## Interleaved files have several SS_cons lines
+            elif line.startswith("#=GS"):
+                names.add(line.split()[1])
+            elif line.strip() and not line.startswith("#"):
+                names.add(line.split()[0])
+
+
+def read_combined_output(tblout_file, alignment_file, model_sources):
+    """Reads the outputs of one cmsearch with several models in one pass over each file.
+    Alignments are assigned to models by the name/from-to keys of their sequences.
+
+    tblout_file (str): Filepath of the --tblout output
+    alignment_file (str): Filepath of the -A output
+    model_sources (dict): Model NAME => cm file (value of cm_hit_src), in search order
+
+    Output:
+    best (df): Best hit per id with the columns of read_tblout plus cm_hit_src and align_cons_3SL
+    """
+    best = {}
+    model_keys = {model: set() for model in model_sources}
+    for model, key, vid, f, t, score in stream_tblout(tblout_file):
+        model_keys.setdefault(model, set()).add(key)
+        if vid not in best or best[vid][2] < score: # Ties go to the earlier hit
+            best[vid] = (f, t, score, model)
+    ss_cons = {}
+    for names, align_cons in stream_stockholm(alignment_file):
+        for model, keys in model_keys.items():
+            if model not in ss_cons and names <= keys:
+                ss_cons[model] = align_cons
+                break
+    return pd.DataFrame([(vid, f, t, score, model_sources.get(model, model), ss_cons.get(model))
+                         for vid, (f, t, score, model) in best.items()],
+                        columns=["id", "cm_hit_f", "cm_hit_t", "score", "cm_hit_src", "align_cons_3SL"])
+
+
+def cm_search_combined_job(cm_path, seq_path, out_file, out_align_file, cpu, seq_file_index, model_sources):
+    """Runs one cmsearch of all models against one sequence file and reads the best hits."""
+    run_cm_search(cm_path, seq_path, out_file, out_align_file, cpu=cpu)
+    hits = read_combined_output(out_file, out_align_file, model_sources)
+    hits["seq_file_index"] = seq_file_index
+    hits["cm_index"] = 0
+    return hits
+
+
+def cm_search(df, cm_dir, seq_dir, output_path, output_file, jobs=1, combined=False):
     """Applies cm_search with a given cm directory on a given
     Sequence directory.
+    All (CM x sequence file) searches run in parallel, each with its own
+    output files {cm}_{sequence file}.cmout and {cm}_{sequence file}_alignment.cmout.
 
     df (df): Dataframe that will be updated with the locations of found matches.
     cm_dir (str): Path to the directory of .cm files. Files need to contain
@@ -74,46 +330,47 @@ def cm_search(df, cm_dir, seq_dir, output_path, output_file):
                   This "main name" also should appear in the seq_dir directory.
                   This can be ignored if cm_dir was also built with this program.
     seq_dir (str): Path to the sequence directory/database.
+    jobs (int): Number of CPUs shared by all cmsearch runs (via --cpu)
+    combined (bool): If True, all CMs are concatenated into {output_path}/all_3SL.cm and
+                     searched with one cmsearch per sequence file ({sequence file}.cmout).
+                     cmsearch still reads the sequence file once per model, so this is not
+                     a single pass over the database: it only starts fewer processes. The
+                     results equal the per-model search, the hits are assigned to their
+                     model from the tblout and alignments by their name/from-to keys
     """
     os.makedirs(output_path, exist_ok=True)
     cm_dir_names = os.listdir(cm_dir)      ## This part is maybe unneccessary
     cm_end = cm_dir_names[0].split("_")[1] ## But I want to ensure modability
     cm_files = [i.split("_")[0] for i in os.listdir(cm_dir)]
     #df = pd.DataFrame()
-    for file in os.listdir(seq_dir):
-        if file.endswith("3UTR.fa"): ## Find the right file
-        
-        ####dir = root.split("/")[-1]
-        ####if dir in cm_files:  # = Match in cm_dir
-        ####for file in files:
-        ####    if file.endswith("3UTR.fa"): 
-            scores = {}
-            for cm_file in cm_files:
-                if not os.path.isfile(f"{cm_dir}/{cm_file}_{cm_end}"):
-                    continue # Skip directories
-                out_file = f"{output_path}/{cm_file}.cmout"
-                out_align_file = f"{output_path}/{cm_file}_alignment.cmout"
-                p = run_cm_search(f"{cm_dir}/{cm_file}_{cm_end}", 
-                                  f"{seq_dir}/{file}", out_file, out_align_file)
-                with open(out_align_file, "r") as f_align:
-                    for line in f_align.readlines():
-                        if line.startswith("#=GC SS_cons"):
-                            align_cons_3SL = line.split()[-1]
-                f = open(out_file, "r")
-                for line in f.readlines():
-                    if line.startswith("#"):
-                        continue
-                    #print(line)
-                    #continue
-                    split_line = line.split()
-                    id = split_line[17]
-                    score = float(split_line[14])
-                    if (not id in scores) or (scores[id] < score):
-                        scores[id] = score # Update score if its better
-                        f, t = split_line[7:9] # Save hit with best score
-                        df.loc[df.id == id, "cm_hit_f"] = int(f)
-                        df.loc[df.id == id, "cm_hit_t"] = int(t)
-                        df.loc[df.id == id, "cm_hit_src"] = cm_file
-                        df.loc[df.id == id, "align_cons_3SL"] = align_cons_3SL
+    cm_files = [cm_file for cm_file in cm_files if os.path.isfile(f"{cm_dir}/{cm_file}_{cm_end}")] # Skip directories
+    seq_files = [file for file in os.listdir(seq_dir) if file.endswith("3UTR.fa")] ## Find the right files
+    grid = []
+    if combined:
+        combined_cm = f"{output_path}/all_3SL.cm"
+        concatenate_cms([f"{cm_dir}/{cm_file}_{cm_end}" for cm_file in cm_files], combined_cm)
+        model_sources = {read_cm_name(f"{cm_dir}/{cm_file}_{cm_end}"): cm_file for cm_file in cm_files}
+        for seq_file_index, file in enumerate(seq_files):
+            out_name = f"{output_path}/{file.rsplit('.', 1)[0]}"
+            grid.append((cm_search_combined_job, combined_cm, f"{seq_dir}/{file}", f"{out_name}.cmout",
+                         f"{out_name}_alignment.cmout", seq_file_index, model_sources))
+    else:
+        for seq_file_index, file in enumerate(seq_files):
+            for cm_index, cm_file in enumerate(cm_files):
+                out_name = f"{output_path}/{cm_file}_{file.rsplit('.', 1)[0]}"
+                grid.append((cm_search_job, f"{cm_dir}/{cm_file}_{cm_end}", f"{seq_dir}/{file}",
+                             f"{out_name}.cmout", f"{out_name}_alignment.cmout",
+                             seq_file_index, cm_index, cm_file))
+    workers = max(1, min(jobs, len(grid)))
+    cpu = max(1, jobs // workers)  ## --cpu share, so that workers * cpu <= jobs
+    hits = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(job, cm_path, seq_path, out_file, out_align_file, cpu, *job_args)
+                   for job, cm_path, seq_path, out_file, out_align_file, *job_args in grid]
+        for future in as_completed(futures):
+            hits.append(future.result())
+    hits = pd.concat(hits) if hits else pd.DataFrame()
+    if len(hits):
+        df = merge_cm_hits(df, best_cm_hits(hits))
     df.to_csv(output_file, index=False)
-    return df
\ No newline at end of file
+    return df
@@ -3,24 +3,40 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
-def plot_energy_histos(IntaRNA_df, output_dir):
-    classlist = []
-    energylist = []
-    grouplist = []
-    interaction_number_list = []
-    for index, row in IntaRNA_df.iterrows():
-        constrained_predictions_t = ast.literal_eval(row["predictions_t"])
-        constrained_predictions_q = ast.literal_eval(row["predictions_q"])
-        for i in range(0, len(constrained_predictions_t)):
-            interaction_t = constrained_predictions_t[i]
-            classlist.append(row["class"])
-            energylist.append(float(interaction_t[2]))
-            interaction_number_list.append(i)
-            if int(interaction_t[0]) <= 0:
-                grouplist.append(0) ## Add to group 1 (5' pos <= 0)
-            else:
-                grouplist.append(1) ## Add to group 2 (5' pos > 0)
-    edf = pd.DataFrame({"vclass": classlist, "interaction_number": interaction_number_list, "group": grouplist, "energy": energylist})
+def plot_energy_histos(IntaRNA_df, output_dir, interactions=None):
+    """
+    IntaRNA_df (df): Dataframe with the predictions (e.g. from main_mrri)
+    output_dir (str): Directory for the energy_{class}.png files
+    interactions (df): Optional interaction table (see interaction_store.load_interactions).
+                       If given, it is used instead of parsing predictions_t.
+
+    Output:
+    outputs (list): Paths of the saved plots
+    """
+    if interactions is not None:
+        interactions_t = interactions[interactions["side"] == "t"].merge(IntaRNA_df[["id", "class"]], on="id")
+        edf = pd.DataFrame({"vclass": interactions_t["class"],
+                            "interaction_number": interactions_t["rank"].astype(int),
+                            "group": (interactions_t["start"] > 0).astype(int), ## 0: 5' pos <= 0, 1: 5' pos > 0
+                            "energy": interactions_t["energy"]})
+    else:
+        classlist = []
+        energylist = []
+        grouplist = []
+        interaction_number_list = []
+        for index, row in IntaRNA_df.iterrows():
+            constrained_predictions_t = ast.literal_eval(row["predictions_t"])
+            for i in range(0, len(constrained_predictions_t)):
+                interaction_t = constrained_predictions_t[i]
+                classlist.append(row["class"])
+                energylist.append(float(interaction_t[2]))
+                interaction_number_list.append(i)
+                if int(interaction_t[0]) <= 0:
+                    grouplist.append(0) ## Add to group 1 (5' pos <= 0)
+                else:
+                    grouplist.append(1) ## Add to group 2 (5' pos > 0)
+        edf = pd.DataFrame({"vclass": classlist, "interaction_number": interaction_number_list, "group": grouplist, "energy": energylist})
+    outputs = []
     for vclass in edf.vclass.unique():
         #for pos_group in [0, 1]:
         filtered_edf = edf.loc[(edf["vclass"]==vclass)]# & (edf["group"]==pos_group)]
@@ -28,4 +44,6 @@ def plot_energy_histos(IntaRNA_df, output_dir):
         #raise
         sns.histplot(filtered_edf, x="energy", hue="interaction_number", multiple="stack", palette={0:"red", 1:"orange", 2:"yellow"})
         plt.savefig(f"{output_dir}/energy_{vclass}.png")
-        plt.close()
\ No newline at end of file
+        plt.close()
+        outputs.append(f"{output_dir}/energy_{vclass}.png")
+    return outputs
\ No newline at end of file
@@ -1,4 +1,9 @@
+import os
+import sys
+import time
+import tempfile
 import seaborn as sns
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 from matplotlib.lines import Line2D
@@ -6,8 +11,8 @@ from matplotlib.patches import Rectangle
 import ast
 import pandas as pd
 import numpy as np
-import math
 from collections import defaultdict
+from Codes.interaction_store import predictions_by_id
 
 
 main_colours = {"UTR": "gray", "main_interaction" : "red", "subopt_interaction": "orange", "interactions": ["red", "orange", "yellow"], "MEME": "red"}
@@ -22,7 +27,30 @@ linewidths = {"UTR": 4,
               "MEME": 16,
               }
 
-def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=False, vertical=False, meme_sites={}):
+def draw_segments(segments, collections=True):
+    """
+    Draws horizontal lines, one LineCollection per axis and line style.
+    Collections are added by zorder and then by layer, so lines overlap
+    like they did as single Line2D artists drawn in that order.
+
+    segments (dict): (axis, layer, colour, linewidth, alpha, zorder) => list of (x_from, x_to, y)
+    collections (bool): If False, every line becomes its own Line2D (slow, see benchmark_lineplots)
+    """
+    for (ax, layer, colour, linewidth, alpha, zorder), lines in sorted(segments.items(), key=lambda item: (item[0][5], item[0][1])):
+        lines = np.asarray(lines, dtype=float).reshape(-1, 3)
+        lines = lines[np.isfinite(lines).all(axis=1)] ## e.g. MEME sites relative to a missing CM hit
+        if not collections:
+            for x_from, x_to, y in lines:
+                ax.plot((x_from, x_to), (y, y), linewidth=linewidth, color=colour, alpha=alpha,
+                        solid_capstyle="butt", zorder=zorder)
+            continue
+        points = np.stack((lines[:, [0, 2]], lines[:, [1, 2]]), axis=1) ## n x (from, to) x (x, y)
+        ax.add_collection(LineCollection(points, colors=colour, linewidths=linewidth, alpha=alpha,
+                                         capstyle="butt", zorder=zorder))
+
+
+def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=False, vertical=False, meme_sites={},
+                   interactions=None, collections=True):
     """
     Draw an interaction lineplot 
     showcasing interaction position relative to UTR/CDS.
@@ -36,6 +64,12 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
     meme_sites (dict): Optional dictionary of meme sites. generated by meme_to_lineplot.
                        Note: Give the class specific dict here not the mega dict!
                        (e.g.: mega_dict[virus_class])
+    interactions (df): Optional interaction table (see interaction_store.load_interactions).
+                       If given, it is used instead of parsing predictions_t/predictions_q.
+    collections (bool): If False, draw every line as its own artist (see draw_segments)
+
+    Output:
+    outputs (list): Paths of the saved plots
     """
     ## Need 2 plots:
     ## 1: UTR5+some_CDS+t_inter (aligned to UTR5/CDS transition)
@@ -43,41 +77,55 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
     no_subopts = False
     no_predictions = False
     no_cm_hits = False
-    appeared_virus_types = {}
+    if interactions is not None:
+        stored_t = predictions_by_id(interactions, "t")
+        stored_q = predictions_by_id(interactions, "q")
     plt.style.use("seaborn-v0_8-darkgrid")
     if vertical:
         fig, (side5, side3) = plt.subplots(2, 1, figsize=(24, 20)) # On top of each other
     else:
         fig, (side5, side3) = plt.subplots(1, 2, figsize=(16, 12)) # Next to each other
+    segments = defaultdict(list) # Line style => [x_from, x_to, y] of all its lines
+
+    ## Plot CDS and UTR (all genomes at once):
+    ## Differentiate between cISFVG and dISFVG
+    virus_types = np.where(df["class"] == "ISFV", df["type"], df["class"])
+    appeared_virus_types = dict.fromkeys(virus_types)
+    cds_colours = np.array([CDS_colours[virus_type] for virus_type in virus_types])
+    y = df.index.to_numpy()
+    UTR5len = df["UTR5len"].to_numpy()
+    UTR3len = df["UTR3len"].to_numpy()
+    for cds_colour in dict.fromkeys(cds_colours):
+        rows = cds_colours == cds_colour
+        segments[(side5, 0, cds_colour, linewidths["CDS"], None, 2)].extend(
+            np.column_stack((np.zeros(rows.sum()), np.full(rows.sum(), extra_bases_roi), y[rows])))
+        segments[(side3, 0, cds_colour, linewidths["CDS"], None, 2)].extend(
+            np.column_stack((-UTR3len[rows], -extra_bases_roi - UTR3len[rows], y[rows])))
+    segments[(side5, 1, main_colours["UTR"], linewidths["UTR"], None, 2)].extend(
+        np.column_stack((np.zeros(len(df)), -UTR5len, y)))
+    segments[(side3, 1, main_colours["UTR"], linewidths["UTR"], None, 2)].extend(
+        np.column_stack((-UTR3len, np.zeros(len(df)), y)))
+
+    ## Plot CM hits:
+    if "cm_hit_f" in df:
+        hits = df[df["cm_hit_f"].notna()]
+        for cm_hit_src, src_hits in hits.groupby("cm_hit_src", sort=False):
+            segments[(side3, 2, CDS_colours[cm_hit_src], linewidths["CMHit"], 0.5, 2)].extend(
+                np.column_stack((src_hits["cm_hit_f"] - src_hits["UTR3len"], src_hits["cm_hit_t"] - src_hits["UTR3len"],
+                                 src_hits.index)))
+    else:
+        no_cm_hits = True
 
     for index, row in df.iterrows():
-        appeared_virus_types[row["type"] if row["class"] == "ISFV" else row["class"]] = 1
-        line5sub = []
-        line3sub = []
-        ## Plot CDS:
-        ## Differentiate between cISFVG and dISFVG
-        cds_colour = CDS_colours[row["type"]] if row["class"] == "ISFV" else CDS_colours[row["class"]]
-        side5.plot((0, extra_bases_roi), (index, index), 
-                   linewidth=linewidths["CDS"], color=cds_colour, solid_capstyle="butt")
-        side3.plot((0 - row["UTR3len"], -extra_bases_roi - row["UTR3len"]), (index, index), 
-                   linewidth=linewidths["CDS"], color=cds_colour, solid_capstyle="butt")
-        ## Plot UTR:
-        side5.plot((0, -row["UTR5len"]), (index, index), 
-                   linewidth=linewidths["UTR"], color=main_colours["UTR"], solid_capstyle="butt")
-        side3.plot((0 - row["UTR3len"], 0), (index, index), 
-                   linewidth=linewidths["UTR"], color=main_colours["UTR"], solid_capstyle="butt")
-
-        ## Plot CM hits:
-        if "cm_hit_f" in row:
-            if not math.isnan(row["cm_hit_f"]):
-                side3.plot((row["cm_hit_f"] - row["UTR3len"], row["cm_hit_t"] - row["UTR3len"]), (index, index), 
-                           linewidth=linewidths["CMHit"], color=CDS_colours[row["cm_hit_src"]], alpha=0.5, solid_capstyle="butt")
-        else:
-            no_cm_hits = True
         ## Plot Interaction Predictions:
-        if "predictions_t" in row:
+        if interactions is not None or "predictions_t" in row:
             counter = 0
-            predictions_t = ast.literal_eval(row["predictions_t"])
+            if interactions is not None:
+                predictions_t = stored_t.get(row["id"], [])
+                predictions_q = stored_q.get(row["id"], [])
+            else:
+                predictions_t = ast.literal_eval(row["predictions_t"])
+                predictions_q = ast.literal_eval(row["predictions_q"])
             for prediction_t in predictions_t: ## 5' Interaction predictions
                 if prediction_t:
                     if subopt_mode:
@@ -87,11 +135,10 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
                             color = main_colours["subopt_interaction"]
                     else:
                         color = main_colours["interactions"][counter]
-                    side5.plot((int(prediction_t[0]), int(prediction_t[1])), (index, index), 
-                                   linewidth=linewidths["Interaction"], color=color, solid_capstyle="butt", zorder=(len(predictions_t)-counter)*10)
+                    segments[(side5, 3, color, linewidths["Interaction"], None, (len(predictions_t)-counter)*10)].append(
+                        (int(prediction_t[0]), int(prediction_t[1]), index))
                     counter += 1
             counter = 0
-            predictions_q = ast.literal_eval(row["predictions_q"])
             for prediction_q in predictions_q: ## 3' Interaction predictions
                 if prediction_q:
                     if subopt_mode:
@@ -101,44 +148,42 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
                             color = main_colours["subopt_interaction"]
                     else:
                         color = main_colours["interactions"][counter]
-                    side3.plot((int(prediction_q[0]) - row["UTR3len"], int(prediction_q[1]) - row["UTR3len"]), (index, index), 
-                                   linewidth=linewidths["Interaction"], color=color, solid_capstyle="butt", zorder=(len(predictions_t)-counter)*10)
+                    segments[(side3, 3, color, linewidths["Interaction"], None, (len(predictions_t)-counter)*10)].append(
+                        (int(prediction_q[0]) - row["UTR3len"], int(prediction_q[1]) - row["UTR3len"], index))
                     counter += 1
         else:
             no_predictions = True
 
     ## Plot MEME sites:
         if meme_sites:
+            meme_style = (linewidths["MEME"], 0.3, 5000)
             ## Plot Site 1:
             if row["id"] in meme_sites["site_1"]:
                 site1 = meme_sites["site_1"][row["id"]]
                 site1_area_start = -40
-                site1_tuple = (site1_area_start + site1[0], site1_area_start + site1[1]) 
-                side5.plot(site1_tuple, (index, index),  linewidth=linewidths["MEME"],
-                           color=main_colours["MEME"],  alpha=0.3,  solid_capstyle="butt", zorder=5000)
+                segments[(side5, 4, main_colours["MEME"], *meme_style)].append(
+                    (site1_area_start + site1[0], site1_area_start + site1[1], index))
             ## Plot Site 2:
             if row["id"] in meme_sites["site_2"]:
                 site2 = meme_sites["site_2"][row["id"]]
                 site2_area_start = 20
-                site2_tuple = (site2_area_start + site2[0], site2_area_start + site2[1])
-                side5.plot(site2_tuple, (index, index),  linewidth=linewidths["MEME"],
-                           color=main_colours["MEME"],  alpha=0.3,  solid_capstyle="butt", zorder=5000)
+                segments[(side5, 4, main_colours["MEME"], *meme_style)].append(
+                    (site2_area_start + site2[0], site2_area_start + site2[1], index))
             ## Plot Site 3:
             if row["id"] in meme_sites["site_3"]:
                 CMhit_start = row["cm_hit_f"] - row["UTR3len"]
                 site3 = meme_sites["site_3"][row["id"]]
                 site3_area_start = CMhit_start-25
-                site3_tuple = (site3_area_start + site3[0], site3_area_start + site3[1])
-                side3.plot(site3_tuple, (index, index),  linewidth=linewidths["MEME"],
-                           color=main_colours["MEME"],  alpha=0.3,  solid_capstyle="butt", zorder=5000)
+                segments[(side3, 4, main_colours["MEME"], *meme_style)].append(
+                    (site3_area_start + site3[0], site3_area_start + site3[1], index))
             ## Plot Site 4:
             if row["id"] in meme_sites["site_4"]:
                 CMhit_start = row["cm_hit_f"] - row["UTR3len"]
                 site4 = meme_sites["site_4"][row["id"]]
                 site4_area_start = CMhit_start+5
-                site4_tuple = (site4_area_start + site4[0], site4_area_start + site4[1])
-                side3.plot(site4_tuple, (index, index),  linewidth=linewidths["MEME"],
-                           color=main_colours["MEME"],  alpha=0.3, solid_capstyle="butt", zorder=5000)
+                segments[(side3, 4, main_colours["MEME"], *meme_style)].append(
+                    (site4_area_start + site4[0], site4_area_start + site4[1], index))
+    draw_segments(segments, collections)
 
     ## Draw Box marking limited region of interest:
     if draw_roi_box:
@@ -192,6 +237,7 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
     #plt.suptitle("Interaction Lineplot", fontsize=48)
     plt.subplots_adjust(wspace=0.05)
     plt.savefig(output, bbox_inches='tight')
+    outputs = [output]
     
     # Save plots separately too: (Optional)
     if vertical:
@@ -200,4 +246,34 @@ def draw_lineplots(df, extra_bases_roi, output, subopt_mode=False, draw_roi_box=
         o_split = output.split(".",1)
         plt.savefig(f"{o_split[0]}_5.{o_split[1]}", bbox_inches=extent5)
         plt.savefig(f"{o_split[0]}_3.{o_split[1]}", bbox_inches=extent3) # .expanded(1.2, 1.2)
-    plt.close()
\ No newline at end of file
+        outputs += [f"{o_split[0]}_5.{o_split[1]}", f"{o_split[0]}_3.{o_split[1]}"]
+    plt.close()
+    return outputs
+
+def benchmark_lineplots(input_df_file_path, extra_bases_roi=100, n_synthetic=5000, output_dir=None):
+    """Times draw_lineplots with LineCollections and with one Line2D per line,
+    on a table and on a synthetic table of n_synthetic genomes drawn from it.
+
+    input_df_file_path (str): Table with predictions_t/predictions_q (e.g. the cm_search output)
+    n_synthetic (int): Number of genomes of the synthetic table
+    output_dir (str): Where the plots are saved (default: a temporary directory)
+    """
+    df = pd.read_csv(input_df_file_path)
+    synthetic = df.sample(n_synthetic, replace=True, random_state=0).reset_index(drop=True)
+    synthetic["id"] = synthetic["id"] + "_" + synthetic.index.astype(str)
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = output_dir or tmp_dir
+        for name, table in [(f"{len(df)} genomes", df), (f"{n_synthetic} genomes", synthetic)]:
+            for collections in [True, False]:
+                start = time.perf_counter()
+                draw_lineplots(table, extra_bases_roi, os.path.join(output_dir, f"benchmark_{len(table)}_{collections}.png"),
+                               subopt_mode=True, collections=collections)
+                times[(name, collections)] = time.perf_counter() - start
+                print(f"{name}, {'LineCollection' if collections else 'Line2D per line'}: {times[(name, collections)]:.2f}s")
+    return times
+
+
+if __name__ == "__main__":
+    matplotlib.use("Agg")
+    benchmark_lineplots(sys.argv[1] if len(sys.argv) > 1 else "Results/cm_search/Inta_plus_CM.csv")
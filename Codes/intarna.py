@@ -1,20 +1,20 @@
 import pandas as pd
 import math
 import subprocess
-from Codes.intarna_help import hacked_MRRI_main
-import string
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Codes.intarna_help import create_MRRI_handler, MRRI_waves, mrri_predictions
+from Codes.MRRI import MRRIParameters
+from Codes.cache import CachedProcess, intarna_version, parameter_file_content
+from Codes.tools import tool_cmd
+from Codes.interaction_store import write_interactions
+
+def region_arguments(UTR5pCDS, UTR3pCDS, extra_bases, extra_bases_roi):
+    """Returns the IntaRNA arguments for the index shift and the region of interest
+    of one genome.
 
-def execute_IntaRNA(UTR5pCDS, UTR3pCDS, ID,
-                    extra_bases, extra_bases_roi, static_param_path,
-                    additional_args=[]):
-    """Starts a subprocess for IntaRNA with given parameters.
-    
     UTR5pCDS (str): 5'UTR+ the extra bases from the CDS
     UTR3pCDS (str): 3'UTR+ the extra bases from the CDS
-    ID (str): ID code of the current sequence ("NC_XXXXX.X")
-    static_param_path (str): Filepath for the static parameter file to be used
-    additional_args (list): Optional additional arguments, must have the form:
-                            ["--par1", str(val1), "--par2",...]
     """
     # roi_difference cuts off the difference between
     # the extra CDS bases and the extra CDS bases as region of interest
@@ -25,58 +25,153 @@ def execute_IntaRNA(UTR5pCDS, UTR3pCDS, ID,
     qidxpos0 = -extra_bases # = -200
     qregion_s = -roi_difference # = -100
     qregion_e = len(UTR3pCDS)-extra_bases # len of UTR3 alone
-    cmd = ["IntaRNA", "-t", UTR5pCDS, "-q", UTR3pCDS,
-           "--tidxpos0", str(tidxpos0), ## Transition UTR5-CDS
-           "--qidxpos0", str(qidxpos0),  ## Transition CDS-UTR3
-           "--tregion", f"{str(tregion_s)}-{str(tregion_e)}", ## UTR5start to end+100CDS
-           "--qregion", f"{str(qregion_s)}-{str(qregion_e)}", ## 100CDS to UTR3end
-           "--tId", f"{ID}.5UTR",
-           "--qId", f"{ID}.3UTR",
-           "--parameterFile", static_param_path,
-           "--outMode", "C"
-           ]
-    cmd += additional_args
+    return ["--tidxpos0", str(tidxpos0), ## Transition UTR5-CDS
+            "--qidxpos0", str(qidxpos0),  ## Transition CDS-UTR3
+            "--tregion", f"{str(tregion_s)}-{str(tregion_e)}", ## UTR5start to end+100CDS
+            "--qregion", f"{str(qregion_s)}-{str(qregion_e)}", ## 100CDS to UTR3end
+            ]
+
+
+def start_IntaRNA(cmd, static_param_path, cache=None):
+    """Starts IntaRNA with the given command or takes its output from the cache.
+
+    cmd (list): Complete IntaRNA command
+    static_param_path (str): Parameter file used in cmd (its content and the files it references are part of the cache key)
+    cache (ResultCache): Optional cache for the IntaRNA output
+    """
     #print(" ".join(cmd))
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    if cache is not None:
+        key = cache.key("IntaRNA", intarna_version(tool_cmd("IntaRNA")[0]), parameter_file_content(static_param_path),
+                        *cmd)
+        cached_output = cache.get(key)
+        if cached_output is not None:
+            return CachedProcess(cached_output)
+    p = subprocess.Popen(tool_cmd(cmd[0]) + cmd[1:], stdout=subprocess.PIPE)
+    if cache is not None:  ## read_output stores the output once it is complete
+        p.cache, p.cache_key = cache, key
     return p
 
 
+def execute_IntaRNA(UTR5pCDS, UTR3pCDS, ID,
+                    extra_bases, extra_bases_roi, static_param_path,
+                    additional_args=[], cache=None):
+    """Starts a subprocess for IntaRNA with given parameters.
+    If a cache is given and already holds the output of the exact same call,
+    no subprocess is started and the cached output is returned instead.
+    
+    UTR5pCDS (str): 5'UTR+ the extra bases from the CDS
+    UTR3pCDS (str): 3'UTR+ the extra bases from the CDS
+    ID (str): ID code of the current sequence ("NC_XXXXX.X")
+    static_param_path (str): Filepath for the static parameter file to be used
+    additional_args (list): Optional additional arguments, must have the form:
+                            ["--par1", str(val1), "--par2",...]
+    cache (ResultCache): Optional cache for the IntaRNA output
+    """
+    cmd = ["IntaRNA", "-t", UTR5pCDS, "-q", UTR3pCDS]
+    cmd += region_arguments(UTR5pCDS, UTR3pCDS, extra_bases, extra_bases_roi)
+    cmd += ["--tId", f"{ID}.5UTR",
+            "--qId", f"{ID}.3UTR",
+            "--parameterFile", static_param_path,
+            "--outMode", "C"
+            ]
+    cmd += additional_args
+    return start_IntaRNA(cmd, static_param_path, cache)
+
+
+class Interaction():
+    """One predicted interaction (one line of the IntaRNA CSV output)."""
+    __slots__ = ("tid", "t_start", "t_end", "qid", "q_start", "q_end", "hybDP", "energy")
+
+    def __init__(self, line):
+        """
+        line (str): Line of the IntaRNA output with the columns
+                    id1;start1;end1;id2;start2;end2;subseqDP;hybridDP;E
+        """
+        tid, ts, te, qid, qs, qe, seqDP, hybDP, e = line.split(";")
+        self.tid = tid
+        self.t_start = int(ts)
+        self.t_end = int(te)
+        self.qid = qid
+        self.q_start = int(qs)
+        self.q_end = int(qe)
+        self.hybDP = hybDP
+        self.energy = float(e.rstrip("\n"))
+
+
+def iter_output(p):
+    """Generator over the decoded lines of the IntaRNA output, as they arrive.
+    If the process was started with a cache, the complete output is stored
+    in it once the process finished successfully.
+    stderr of IntaRNA is not piped, so only stdout has to be drained here.
+
+    p (subprocess): Process created by execute_IntaRNA
+    """
+    cache = getattr(p, "cache", None)
+    chunks = []  ## Raw bytes, only kept for the cache
+    for out in p.stdout:
+        if cache is not None:
+            chunks.append(out)
+        yield out.decode("utf-8")
+    if p.wait() == 0 and cache is not None:
+        cache.put(p.cache_key, b"".join(chunks))
+
+
 def read_output(p, f):
-    """Reads output of the IntaRNA process,
-    writes the output in a currently open file f
-    and processes the data to return the relevant parts.
+    """Reads output of the IntaRNA process line by line,
+    writes each line into a currently open file f
+    and parses it into an Interaction.
     
     p (subprocess): Process created by execute_IntaRNA
     f (open file): File for the raw output
+
+    Output:
+    interactions (list): Interactions in the order of the IntaRNA output
     """
-    t_starts = []
-    t_ends = []
-    q_starts = []
-    q_ends = []
-    energy = []
-    hybDPs = []
-    p_output = list(p.stdout)
-    f.write(p_output[0].decode("utf-8")) # header
-    for out in p_output[1:]:
-        opt = out.decode("utf-8")
+    interactions = []
+    lines = iter_output(p)
+    for opt in lines:
+        f.write(opt) # header
+        break
+    for opt in lines:
         f.write(opt)
-        tid, ts, te, qid, qs, qe, seqDP, hybDP, e = opt.split(";")
-        t_starts.append(int(ts))
-        t_ends.append(int(te))
-        q_starts.append(int(qs))
-        q_ends.append(int(qe))
-        energy.append(float(e.rstrip("\n")))
-        hybDPs.append(hybDP)
-    return t_starts, t_ends, q_starts, q_ends, energy, hybDPs
+        interactions.append(Interaction(opt))
+    return interactions
+
+
+def run_intarna_job(row, extra_bases, extra_bases_roi, static_param_path,
+                    outNumber, outOverlap, cache=None):
+    """Runs a single IntaRNA call for one row of the parameter table
+    and buffers its raw output, so it can be written in order later.
+
+    row (Series): Row of the parameter table
+    outNumber (int): Sets how many subopts are allowed (N-1)
+    outOverlap (str): Value for "--outOverlap" ("T" or "Q")
+    cache (ResultCache): Optional cache for the IntaRNA output
+
+    Output:
+    raw (str): Raw IntaRNA output of this call
+    interactions (list): Parsed output as returned by read_output
+    """
+    buffer = io.StringIO()
+    p = execute_IntaRNA(row["seq5"], row["seq3"], row['id'],
+                        extra_bases, extra_bases_roi, static_param_path,
+                        ["--outNumber", str(outNumber), "--outOverlap", outOverlap],
+                        cache=cache)
+    interactions = read_output(p, buffer)
+    return buffer.getvalue(), interactions
 
 
 def main_intarna(static_param_path, extra_bases, extra_bases_roi,
                  parameter_table_file, output_path, raw_intarna_output_path,
-                 outNumber):
+                 outNumber, jobs=1, cache=None, interactions_path=None):
     """
     Main IntaRNA process.
     Iterates over the parameter file, runs IntaRNA for each row and 
     returns the outputs as a single dataframe.
+    All IntaRNA calls are run in a pool of at most `jobs` processes,
+    the results are still written in the order of the parameter file.
+    A finished call is only kept until its row is written, so the raw
+    outputs of all genomes are never held at the same time.
     
     static_param_path (str): Filepath for the file that will be fed to IntaRNA directly
     extra_bases (int): #Extra bases of the CDS to include in IntaRNA input
@@ -85,6 +180,9 @@ def main_intarna(static_param_path, extra_bases, extra_bases_roi,
     output_path (str): Where to save the output file
     raw_intarna_output_path (str): Where to save the raw IntaRNA output
     outNumber (int): Sets how many subopts are allowed (N-1)
+    jobs (int): Maximum number of IntaRNA processes running at the same time
+    cache (ResultCache): Optional cache, unchanged calls are not run again
+    interactions_path (str): If given, also save the predictions as interaction table there
     
     Output:
     output (df): Resulting dataframe with the IntaRNA results
@@ -93,53 +191,75 @@ def main_intarna(static_param_path, extra_bases, extra_bases_roi,
     output = pd.DataFrame()
     t_ranges = []  ## All constrained interactions of all sequences
     q_ranges = []
-    with open(raw_intarna_output_path, "w") as f:
-        for index, row in params.iterrows():
-            f.write(f"{row['id']} :\n")
-            f.write(f"{'#'*(len(row['id']) + 2)}\n")
-
-
-            p = execute_IntaRNA(row["seq5"], row["seq3"], row['id'],
-                                extra_bases, extra_bases_roi, static_param_path,
-                                 ["--outNumber", str(outNumber), "--outOverlap", "T"])
-            t_starts, t_ends, q_starts, q_ends, energy, hybDPs = read_output(p, f)
-            p.wait()
-            if outNumber > 1:
-                p = execute_IntaRNA(row["seq5"], row["seq3"], row['id'],
-                                    extra_bases, extra_bases_roi, static_param_path,
-                                    ["--outNumber", str(outNumber), "--outOverlap", "Q"])
-                t_starts_2, t_ends_2, q_starts_2, q_ends_2, energy_2, hybDPs_2 = read_output(p, f)
-                t_starts += t_starts_2[1:]
-                t_ends += t_ends_2[1:]
-                q_starts += q_starts_2[1:]
-                q_ends += q_ends_2[1:]
-                energy += energy_2[1:]
-                hybDPs += hybDPs_2[1:]
-            f.write(f"{'#'*(len(row['id']) + 2)}\n")
-            
-            inter_ts = []
-            inter_qs = []
-            for i in range(len(t_starts)):
-                inter_ts.append((t_starts[i], t_ends[i], energy[i], hybDPs[i]))
-                inter_qs.append((q_starts[i], q_ends[i], energy[i], hybDPs[i]))
-            t_ranges.append(inter_ts)
-            q_ranges.append(inter_qs)
+    overlaps = ["T", "Q"] if outNumber > 1 else ["T"]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool, \
+         open(raw_intarna_output_path, "w") as f:
+        ## Submit every call first, the pool decides how many run at once
+        futures = {}  ## future => (position of the row, position of the overlap mode)
+        for position, (index, row) in enumerate(params.iterrows()):
+            for k, overlap in enumerate(overlaps):
+                futures[pool.submit(run_intarna_job, row, extra_bases, extra_bases_roi,
+                                    static_param_path, outNumber, overlap, cache)] = (position, k)
+        ids = list(params["id"])
+        finished = {}  ## position of the row => results of its overlap modes so far
+        next_position = 0
+        for future in as_completed(list(futures)):
+            position, k = futures.pop(future)
+            finished.setdefault(position, [None] * len(overlaps))[k] = future.result()
+            ## Write every row whose calls are all done, in the order of the parameter file
+            while None not in finished.get(next_position, [None]):
+                results = finished.pop(next_position)
+                vid = ids[next_position]
+                next_position += 1
+                f.write(f"{vid} :\n")
+                f.write(f"{'#'*(len(vid) + 2)}\n")
+                raw, interactions = results[0]
+                f.write(raw)
+                for raw, interactions_2 in results[1:]:
+                    f.write(raw)
+                    interactions += interactions_2[1:]
+                f.write(f"{'#'*(len(vid) + 2)}\n")
+
+                inter_ts = []
+                inter_qs = []
+                for i in interactions:
+                    inter_ts.append((i.t_start, i.t_end, i.energy, i.hybDP))
+                    inter_qs.append((i.q_start, i.q_end, i.energy, i.hybDP))
+                t_ranges.append(inter_ts)
+                q_ranges.append(inter_qs)
     output = params
     output = params
     output["predictions_t"] = t_ranges
     output["predictions_q"] = q_ranges
     output.to_csv(output_path, index=False)
+    if interactions_path:
+        write_interactions(interactions_path, list(params["id"]), t_ranges, q_ranges, source_csv=output_path)
     return output
 
 
 def main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_roi, 
-              mrri_file_output, raw_mrri_output, param_mode):
+              mrri_file_output, raw_mrri_output, param_mode, cache=None,
+              interactions_path=None, jobs=1, max_k=3, max_energy=None,
+              stop_on_overlap=False, stop_on_worse=False):
     """
     param_mode (int): Decides region of interest for MRRI
                       1 - Whole sequence from 5' to 100 into CDS and last 100 to 3' end
                       2 - Limited to small area around 5'UTR/CDS transition and short area in 3' UTR
+    cache (ResultCache): Optional cache for the IntaRNA calls of MRRI
+    interactions_path (str): If given, also save the predictions as interaction table there
+    jobs (int): Number of IntaRNA calls running at the same time. The rounds of all
+                genomes run in waves (see MRRI_waves).
+    max_k (int): Maximal number of sites per genome (None: until converged)
+    max_energy (float): Sites with a higher E_hybrid end the search (None: no limit)
+    stop_on_overlap (bool): A site overlapping an earlier one ends the search (see MRRI.acceptSite)
+    stop_on_worse (bool): A site with a higher E_hybrid than the last one ends the search
     """
     params = pd.read_csv(parameter_table_file)
+    mrri_params = MRRIParameters(static_param_path, cache=cache) ## Shared by all genomes
+    handlers = [create_MRRI_handler(row["seq5"], row["seq3"], static_param_path, params=mrri_params)
+                for index, row in params.iterrows()]
+    all_interactions = MRRI_waves(handlers, param_mode, jobs=jobs, max_k=max_k, max_energy=max_energy,
+                                  stop_on_overlap=stop_on_overlap, stop_on_worse=stop_on_worse)
     output = pd.DataFrame()
     t_ranges = []  ## All constrained interactions of all sequences
     q_ranges = []
@@ -150,25 +270,10 @@ def main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_
             print(f"MRRI: {row['id']}")
             f_raw.write(f"{row['id']} :\n")
             f_raw.write(f"{'#'*(len(row['id']) + 2)}\n")
-            interactions = hacked_MRRI_main(row["seq5"], row["seq3"], static_param_path, param_mode)
+            interactions = all_interactions[index]
             f_raw.write(f"{interactions}\n")
 
-            inter_ts = []
-            inter_qs = []
-            for i in range(0, len(interactions)):
-                interaction = interactions[i]
-                #print(interaction)
-                hybDP_0, hybDP_1 = interaction["hybridDP"].split("&")
-                hybDP_0 = hybDP_0.replace("(", string.ascii_uppercase[i])
-                hybDP_1 = hybDP_1.replace(")", string.ascii_lowercase[i])
-                s1 = int(interaction["start1"])
-                e1 = int(interaction["end1"])
-                if s1 >= 0:
-                    s1 = str(s1-1)
-                if e1 >= 0:
-                    e1 = str(e1-1)
-                inter_ts.append((s1, e1, interaction['E'], hybDP_0))
-                inter_qs.append((interaction["start2"], interaction["end2"], interaction['E'], hybDP_1))
+            inter_ts, inter_qs = mrri_predictions(interactions)
             #raise
             t_ranges.append(inter_ts)
             q_ranges.append(inter_qs)
@@ -176,4 +281,7 @@ def main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_
     output = params
     output["predictions_t"] = t_ranges
     output["predictions_q"] = q_ranges
-    output.to_csv(mrri_file_output, index=False)
\ No newline at end of file
+    output.to_csv(mrri_file_output, index=False)
+    if interactions_path:
+        write_interactions(interactions_path, list(params["id"]), t_ranges, q_ranges, mode=param_mode,
+                           source_csv=mrri_file_output)
\ No newline at end of file
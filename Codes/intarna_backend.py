@@ -0,0 +1,83 @@
+import sys
+import abc
+import subprocess
+from Codes.cache import intarna_version, parameter_file_content
+from Codes.tools import tool_cmd
+
+
+class IntaRNABackend(abc.ABC):
+    """
+    Interface for the different ways of running IntaRNA.
+    A backend gets the two sequences and all remaining IntaRNA arguments
+    and returns [stdout, stderr] of the prediction, or None if IntaRNA failed.
+    The sequences get the ids "query" and "target" like inline sequences.
+    """
+
+    @abc.abstractmethod
+    def run(self, query, target, args):
+        """Predicts the interaction of query and target, returns [stdout, stderr] or None."""
+
+    def version(self):
+        """Version string of the IntaRNA used by this backend."""
+        return ""
+
+
+class SubprocessBackend(IntaRNABackend):
+    """
+    Runs IntaRNA as a subprocess without a shell in between.
+    The query is fed as FASTA over stdin ("-q STDIN"), so at most the
+    target sequence ends up on the command line.
+    Every prediction starts a new IntaRNA process: IntaRNA offers no server
+    or library interface here, so there is no persistent backend that keeps
+    one process (and its loaded energy parameters) alive between calls.
+    """
+
+    def __init__(self, intarna_bin="IntaRNA"):
+        """
+        intarna_bin (str): Name or path of the IntaRNA binary
+        """
+        self.intarna_bin = tool_cmd(str(intarna_bin))[0]
+
+    def run(self, query, target, args):
+        cmd = [self.intarna_bin, "-q", "STDIN", "-t", target] + list(args)
+        p = subprocess.run(cmd, input=f">query\n{query}\n",
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True)
+        if p.returncode:  # If IntaRNA exits with a returncode != 0, skip this iteration
+            sys.stderr.write("IntaRNA failed ({}) for call {}\n".format(p.stderr, " ".join(cmd)))
+            return None
+        return [p.stdout, p.stderr]
+
+    def version(self):
+        return intarna_version(self.intarna_bin)
+
+
+class CachedBackend(IntaRNABackend):
+    """
+    Wraps another backend and answers repeated predictions from a ResultCache.
+    """
+
+    def __init__(self, backend, cache, parameter_file=""):
+        """
+        backend (IntaRNABackend): Backend that runs the predictions missing in the cache
+        cache (ResultCache): Cache for the outputs
+        parameter_file (str): IntaRNA parameter file used by the calls (part of the key)
+        """
+        self.backend = backend
+        self.cache = cache
+        self.parameter_file = parameter_file
+
+    def run(self, query, target, args):
+        key = self.cache.key("IntaRNA", self.backend.version(), parameter_file_content(self.parameter_file),
+                             query, target, *args)
+        cached = self.cache.get(key)
+        if cached is not None:
+            stdout, stderr = cached.decode("utf-8").split("\0", 1)
+            return [stdout, stderr]
+        output = self.backend.run(query, target, args)
+        if output is not None:
+            self.cache.put(key, "\0".join(output))
+        return output
+
+    def version(self):
+        return self.backend.version()
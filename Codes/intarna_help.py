@@ -1,32 +1,94 @@
-from Codes.MRRI_main import main
-import sys
+import string
+from Codes.MRRI import MRRI, MRRIParameters
+from concurrent.futures import ThreadPoolExecutor
 
 
-def hacked_MRRI_main(UTR5pCDS, UTR3pCDS, static_param_path, param_mode):
+def create_MRRI_handler(UTR5pCDS, UTR3pCDS, static_param_path, cache=None, backend=None, params=None):
+    """Creates the MRRI handler of one genome, without touching sys.argv (thread-safe).
+
+    cache (ResultCache): Optional cache for the IntaRNA calls
+    backend (IntaRNABackend): Optional backend running IntaRNA (default: SubprocessBackend)
+    params (MRRIParameters): Settings shared with other genomes, replaces
+                             static_param_path, cache and backend if given
+    """
+    if params is None:
+        params = MRRIParameters(static_param_path, backend=backend, cache=cache)
+    return MRRI.fromSequences(UTR3pCDS, UTR5pCDS, params)
+
+
+def MRRI_waves(handlers, param_mode, jobs=1, max_k=3, **convergence):
+    """Runs the MRRI rounds of many genomes in waves: round 1 of all genomes
+    in a pool of jobs workers, then round 2 of the genomes with a new site in
+    round 1, and so on. Rounds depend on each other only within a genome.
+    Same sites as MRRI.runSites of every handler.
+
+    handlers (list): MRRI handlers, one per genome (see create_MRRI_handler)
+    param_mode (int): Decides region of interest for MRRI (see hacked_MRRI_main)
+    jobs (int): Number of IntaRNA calls running at the same time
+    max_k (int): Maximal number of sites per genome (None: until converged)
+    convergence: max_energy, stop_on_overlap, stop_on_worse (see MRRI.acceptSite)
+
+    Output:
+    interactions (list): Per handler the list of blocks like hacked_MRRI_main returns it
+    """
+    blocks = [[] for _ in handlers]
+    current = {}  ## Handler index => input block of the next round
+    for i, MRRIHandler in enumerate(handlers):
+        qId = next(iter(MRRIHandler.querySeq.keys()))
+        tId = next(iter(MRRIHandler.targetSeq.keys()))
+        current[i] = dict({ 'id1': tId, 'id2' : qId})
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while current:
+            futures = {i: executor.submit(handlers[i].runIntaRNA, B, param_mode) for i, B in current.items()}
+            current = {}
+            for i, future in futures.items():
+                B = future.result()
+                if handlers[i].acceptSite(blocks[i], B, **convergence):
+                    blocks[i].append(B)
+                    if max_k is None or len(blocks[i]) < max_k:
+                        current[i] = B
+    BErr = {"start1":0, "end1":0, "start2":0, "end2":0, "hybridDP":0}
+    return [b if b else [dict(BErr)] for b in blocks] ## First IntaRNA round didnt find anything
+
+
+def hacked_MRRI_main(UTR5pCDS, UTR3pCDS, static_param_path, param_mode, cache=None, backend=None, max_k=3):
     """
     param_mode (int): Decides region of interest for MRRI
                       1 - Whole sequence from 5' to 100 into CDS and last 100 to 3' end
                       2 - Limited to small area around 5'UTR/CDS transition and short area in 3' UTR
+    cache (ResultCache): Optional cache for the IntaRNA calls
+    backend (IntaRNABackend): Optional backend running IntaRNA (default: SubprocessBackend)
+    max_k (int): Maximal number of sites (see MRRI.runSites)
+    """
+    MRRIHandler = create_MRRI_handler(UTR5pCDS, UTR3pCDS, static_param_path, cache, backend)
+    sites = MRRIHandler.runSites(param_mode, max_k=max_k)
+    if not sites:
+        BErr = {"start1":0, "end1":0, "start2":0, "end2":0, "hybridDP":0}
+        return [BErr] ## First IntaRNA round didnt find anything
+    return sites
+
+
+def mrri_predictions(interactions):
+    """Turns the MRRI blocks of one genome into its predictions_t/predictions_q entries.
+
+    interactions (list): Blocks returned by MRRI_waves/hacked_MRRI_main
+
+    Output:
+    inter_ts (list), inter_qs (list): (start, end, energy, hybridDP) of every site on the 5'/3' side
     """
-    sys.argv = ["Codes/MRRI_main.py", "-q", UTR3pCDS, "-t", UTR5pCDS, "-p", static_param_path]
-    MRRIHandler = main()
-    for qId in MRRIHandler.querySeq.keys():
-        for tId in MRRIHandler.targetSeq.keys():
-            BE = dict({ 'id1': tId, 'id2' : qId})
-            B1 = MRRIHandler.runIntaRNA(BE, param_mode)
-            #print(B1)
-            if "id2" in B1:
-                B2 = MRRIHandler.runIntaRNA(B1, param_mode)
-            else:
-                BErr = {"start1":0, "end1":0, "start2":0, "end2":0, "hybridDP":0}
-                return [BErr] ## First IntaRNA round didnt find anything
-            #print(B2)
-            if "id2" in B2:
-                B3 = MRRIHandler.runIntaRNA(B2, param_mode)
-            else:
-                return [B1]
-            #print(B3)
-            if "id2" in B3:
-                return [B1, B2, B3]
-            else:
-                return [B1, B2]
+    inter_ts = []
+    inter_qs = []
+    for i in range(0, len(interactions)):
+        interaction = interactions[i]
+        hybDP_0, hybDP_1 = interaction["hybridDP"].split("&")
+        hybDP_0 = hybDP_0.replace("(", string.ascii_uppercase[i])
+        hybDP_1 = hybDP_1.replace(")", string.ascii_lowercase[i])
+        s1 = int(interaction["start1"])
+        e1 = int(interaction["end1"])
+        if s1 >= 0:
+            s1 = str(s1-1)
+        if e1 >= 0:
+            e1 = str(e1-1)
+        inter_ts.append((s1, e1, interaction['E'], hybDP_0))
+        inter_qs.append((interaction["start2"], interaction["end2"], interaction['E'], hybDP_1))
+    return inter_ts, inter_qs
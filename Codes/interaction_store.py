@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import pandas as pd
+from Codes.parameters import file_hash
+
+
+## Columns of the interaction table as stored on disk.
+## id is an index into the id list, hybridDP an (offset, length) into the string heap.
+record_dtype = np.dtype([("id", "u4"),
+                         ("side", "u1"),   # 0: 5' side (predictions_t), 1: 3' side (predictions_q)
+                         ("rank", "u2"),   # Position in predictions_t/predictions_q of the id
+                         ("start", "i4"),
+                         ("end", "i4"),
+                         ("energy", "f8"),
+                         ("dp_offset", "u8"),
+                         ("dp_length", "u4"),
+                         ("mode", "u1"),   # 0: IntaRNA, 1/2: param_mode of MRRI
+                         ])
+sides = np.array(["t", "q"])
+
+
+def source_record(source_csv):
+    """Size, mtime and hash of the CSV an interaction table was written with."""
+    stat = os.stat(source_csv)
+    return f"{stat.st_size}\t{stat.st_mtime_ns}\t{file_hash(source_csv)}"
+
+
+def matches_source(path, source_csv):
+    """Whether the interaction table at path was written with source_csv as it is now.
+    The CSV is only hashed if its size matches but its mtime changed (e.g. a copy).
+    """
+    try:
+        with open(f"{path}.source", "r") as f:
+            size, mtime_ns, digest = f.read().split("\t")
+        stat = os.stat(source_csv)
+    except (OSError, ValueError):
+        return False
+    if int(size) != stat.st_size:
+        return False
+    return int(mtime_ns) == stat.st_mtime_ns or digest == file_hash(source_csv)
+
+
+def write_interactions(path, ids, predictions_t, predictions_q, mode=0, source_csv=None):
+    """Writes the predictions of all ids as a long format interaction table.
+    Creates the files {path}.npy (records), {path}.ids.npy (ids) and {path}.heap (hybridDPs).
+    With source_csv, {path}.source records the CSV the table shadows (see load_interactions).
+
+    path (str): Filepath without ending
+    ids (list): Ids of the sequences, in the order of the parameter table
+    predictions_t (list): For each id the list of (start, end, energy, hybridDP) on the 5' side
+    predictions_q (list): For each id the list of (start, end, energy, hybridDP) on the 3' side
+    mode (int): Run mode stored with every interaction (0: IntaRNA, 1/2: MRRI param_mode)
+    source_csv (str): CSV with the same predictions, already written
+    """
+    n = sum(len(p) for p in predictions_t) + sum(len(p) for p in predictions_q)
+    records = np.zeros(n, dtype=record_dtype)
+    heap = bytearray()
+    i = 0
+    for id_index, predictions in enumerate(zip(predictions_t, predictions_q)):
+        for side, side_predictions in enumerate(predictions):
+            for rank, (start, end, energy, hybDP) in enumerate(side_predictions):
+                dp = str(hybDP).encode("utf-8")
+                records[i] = (id_index, side, rank, int(start), int(end), float(energy),
+                              len(heap), len(dp), mode)
+                heap += dp
+                i += 1
+    np.save(f"{path}.npy", records)
+    np.save(f"{path}.ids.npy", np.array(ids, dtype=str))
+    with open(f"{path}.heap", "wb") as f:
+        f.write(heap)
+    if source_csv:
+        with open(f"{path}.source", "w") as f:
+            f.write(source_record(source_csv))
+    elif os.path.isfile(f"{path}.source"):
+        os.remove(f"{path}.source")
+
+
+def load_interactions(path, missing_ok=False, source_csv=None):
+    """Loads an interaction table written by write_interactions.
+    The records are read in one piece, only the strings are decoded.
+
+    path (str): Filepath without ending
+    missing_ok (bool): If True, return None if there is no table at path
+    source_csv (str): If given, return None unless the table was written with this CSV
+                      in its current state (see matches_source), so callers fall back to the CSV
+
+    Output:
+    interactions (df): One row per interaction with the columns
+                       id, side ("t"/"q"), rank, start, end, energy, hybridDP, mode
+    """
+    if missing_ok and not os.path.isfile(f"{path}.npy"):
+        return None
+    if source_csv and not matches_source(path, source_csv):
+        return None
+    records = np.load(f"{path}.npy")
+    ids = np.load(f"{path}.ids.npy")
+    with open(f"{path}.heap", "rb") as f:
+        heap = f.read()
+    hybDPs = [heap[o:o+l].decode("utf-8") for o, l in zip(records["dp_offset"].tolist(),
+                                                          records["dp_length"].tolist())]
+    return pd.DataFrame({"id": ids[records["id"]],
+                         "side": sides[records["side"]],
+                         "rank": records["rank"],
+                         "start": records["start"],
+                         "end": records["end"],
+                         "energy": records["energy"],
+                         "hybridDP": hybDPs,
+                         "mode": records["mode"],
+                         })
+
+
+def predictions_by_id(interactions, side):
+    """Groups the interactions of one side into the form of the
+    predictions_t/predictions_q columns, without parsing any strings.
+
+    interactions (df): Table returned by load_interactions
+    side (str): "t" for the 5' side, "q" for the 3' side
+
+    Output:
+    predictions (dict): id => list of (start, end, energy, hybridDP) ordered by rank
+    """
+    side_df = interactions[interactions["side"] == side].sort_values(["id", "rank"], kind="stable")
+    predictions = {}
+    for vid, start, end, energy, hybDP in zip(side_df["id"], side_df["start"], side_df["end"],
+                                             side_df["energy"], side_df["hybridDP"]):
+        predictions.setdefault(vid, []).append((start, end, energy, hybDP))
+    return predictions
@@ -4,9 +4,24 @@ import collections
 import math
 import ast
 from Codes.locarna_help import (run_mlocarna, run_rnaalifold, run_ps_to_pdf, 
-                                find_all, integrate_into, cm_compare,
-                                get_special_combined_constraint)
-import string
+                                find_all,
+                                get_special_combined_constraints,
+                                run_locarna_pair, upgma_tree)
+from concurrent.futures import ThreadPoolExecutor
+from Codes.interaction_store import load_interactions, predictions_by_id
+from Codes.constraints import build_constraints
+
+
+def locarna_fasta_entry(i, skip_FS=False):
+    """Returns the FASTA record of one seq_dir entry with its constraints."""
+    record = f">{i[0]}\n"
+    record += f"{i[1]}NNNNNNN{i[2]}\n" ## part5NNNNNNNpart3
+    record += f"{i[3]} #S\n"           ## cons_S
+    record += f"{i[4]} #1\n"           ## cons_1
+    record += f"{i[5]} #2\n"           ## cons_2
+    if not skip_FS:
+        record += f"{i[6]} #FS\n"          ## cons_FS
+    return record + "\n"
 
 
 def make_locarna_fasta(l, output_name, skip_FS=False):
@@ -19,24 +34,94 @@ def make_locarna_fasta(l, output_name, skip_FS=False):
     with open(output_name, "w") as f:
         for i in l:
             if len(i[1]) > 0 and len(i[2]) > 0:
-                f.write(f">{i[0]}\n")
-                f.write(f"{i[1]}NNNNNNN{i[2]}\n") ## part5NNNNNNNpart3
-                f.write(f"{i[3]} #S\n")           ## cons_S
-                f.write(f"{i[4]} #1\n")           ## cons_1
-                f.write(f"{i[5]} #2\n")           ## cons_2
-                if not skip_FS:
-                    f.write(f"{i[6]} #FS\n")          ## cons_FS
-                f.write(f"\n")
+                f.write(locarna_fasta_entry(i, skip_FS=skip_FS))
+
+
+def check_fs_balance(vid, cons_FS):
+    """Warns if the brackets/letters of a #FS constraint do not pair up."""
+    if not ((cons_FS.count("(") == cons_FS.count(")"))
+       and (cons_FS.count("A") == cons_FS.count("a"))
+       and (cons_FS.count("B") == cons_FS.count("b"))
+       and (cons_FS.count("C") == cons_FS.count("c"))):
+       print(f"FS constraint unbalanced for {vid}")
+
+
+def make_guide_trees(seq_dir, output_path, skip_FS, temperature, jobs, cache):
+    """Writes a UPGMA guide tree {output_path}/{group}.tree for every group
+    from pairwise locarna scores. Each pair is aligned only once: pairs shared
+    by several groups (e.g. MBFV pairs in MBFV and MBFV+TBFV) are deduplicated,
+    and pairs of earlier runs come from the cache, so the combined groups only
+    compute their cross-group pairs.
+
+    seq_dir (dict): Group => seq_dir entries
+    cache (ResultCache): Store for the pairwise scores
+
+    Output:
+    trees (dict): Group => filepath of its guide tree (groups with less than
+                  3 sequences or failed pairs are missing)
+    """
+    records = {}
+    pairs = set()
+    for seq_class, entries in seq_dir.items():
+        records[seq_class] = {i[0]: locarna_fasta_entry(i, skip_FS=skip_FS)
+                              for i in entries if len(i[1]) > 0 and len(i[2]) > 0}
+        texts = sorted(records[seq_class].values())
+        pairs.update((a, b) for index, a in enumerate(texts) for b in texts[index+1:])
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {pair: executor.submit(run_locarna_pair, *pair, temperature=temperature, cache=cache)
+                   for pair in sorted(pairs)}
+        pair_scores = {pair: future.result() for pair, future in futures.items()}
+    trees = {}
+    for seq_class, group_records in records.items():
+        names = list(group_records)
+        if len(names) < 3:
+            continue ## Nothing to guide
+        scores = {}
+        for index, a in enumerate(names):
+            for b in names[index+1:]:
+                scores[frozenset((a, b))] = pair_scores[tuple(sorted((group_records[a], group_records[b])))]
+        if None in scores.values():
+            continue ## mlocarna computes the tree itself
+        trees[seq_class] = f"{output_path}/{seq_class}.tree"
+        with open(trees[seq_class], "w") as f:
+            f.write(upgma_tree(names, scores) + "\n")
+    return trees
+
+
+def run_locarna_group(seq_class, entries, output_path, use_carna, skip_FS, mode, temperature, threads,
+                      tree_file=None):
+    """Pipeline of one group: mlocarna => RNAalifold => ps2pdf of both plots.
+    
+    seq_class (str): Name of the group
+    entries (list): seq_dir entries of the group (see make_locarna_fasta)
+    threads (int): Threads of mlocarna
+    tree_file (str): Optional guide tree for mlocarna
+    """
+    fasta_file_name = f"{output_path}/locARNA_{seq_class}_input.fa"
+    make_locarna_fasta(entries, fasta_file_name, skip_FS=skip_FS)
+    run_mlocarna(fasta_file_name, f"{output_path}/{seq_class}", use_carna, temperature=temperature, threads=threads,
+                 tree_file=tree_file)
+    run_rnaalifold(f"{output_path}/{seq_class}/results", entries, mode=mode, locARNA_input=fasta_file_name, temperature=temperature)
+    run_ps_to_pdf(f"{output_path}/{seq_class}/results/alirna.ps", f"{output_path}/{seq_class}_alirna.pdf")
+    run_ps_to_pdf(f"{output_path}/{seq_class}/results/aln.ps", f"{output_path}/{seq_class}_aln.pdf")
 
 
 def main_locarna(input_df_file_path, cm_path, output_path,
                  CDS_left, CDS_right, 
                  CMHit_left, CMHit_right, 
-                 use_carna=False, skip_FS=False, mode=1, temperature=18):
+                 use_carna=False, skip_FS=False, mode=1, temperature=18,
+                 interactions_path=None, jobs=1, cache=None):
     """Run locARNA with RNAalifold.
+    The groups are independent, so their pipelines run concurrently.
     param_df_path (str): Path to the parameter dataframe
     cm_path (str): Path to the dataframe resulting from CMSearch
     output_path (int): Output directory for the extracted sequences
+    interactions_path (str): Optional interaction table of the input (see interaction_store),
+                             used instead of parsing predictions_t/predictions_q if it exists
+                             and was written with the input dataframe
+    jobs (int): Number of CPUs shared by the mlocarna runs (via --threads)
+    cache (ResultCache): Optional store for pairwise locarna scores. If given, the guide trees
+                         are built from stored scores (see make_guide_trees). Not used with carna.
     """
     os.makedirs(output_path, exist_ok=True)
 
@@ -47,7 +132,14 @@ def main_locarna(input_df_file_path, cm_path, output_path,
     input_df["cm_hit_src"] = pd.Series(cm_results["cm_hit_src"])
     input_df["align_cons_3SL"] = pd.Series(cm_results["align_cons_3SL"])
 
+    interactions = (load_interactions(interactions_path, missing_ok=True, source_csv=input_df_file_path)
+                    if interactions_path else None)
+    if interactions is not None:
+        stored_t = predictions_by_id(interactions, "t")
+        stored_q = predictions_by_id(interactions, "q")
     seq_dir = collections.defaultdict(list)
+    id_entries = collections.defaultdict(list) ## id => its entries in seq_dir
+    special_folds = {} ## id => (sequence, cons_FS) for get_special_combined_constraints
     for index, row in input_df.iterrows():
         if not "cm_hit_f" in row:
             raise Exception("Dataframe provided does not contain CM-search hits")
@@ -55,8 +147,12 @@ def main_locarna(input_df_file_path, cm_path, output_path,
             continue
         ranges_t = []
         ranges_q = []
-        ranges_t += ast.literal_eval(row["predictions_t"])
-        ranges_q += ast.literal_eval(row["predictions_q"])
+        if interactions is not None:
+            ranges_t += stored_t.get(row["id"], [])
+            ranges_q += stored_q.get(row["id"], [])
+        else:
+            ranges_t += ast.literal_eval(row["predictions_t"])
+            ranges_q += ast.literal_eval(row["predictions_q"])
         seq5 = row["seq5"]
         seq3 = row["seq3"]
         cm_hit_f = int(row["cm_hit_f"])
@@ -65,90 +161,48 @@ def main_locarna(input_df_file_path, cm_path, output_path,
         #CMhit_start = cm_hit_f - row["UTR3len"]
         align_cons_3SL = row["align_cons_3SL"]
         
-        ## How much to cut of from the 5' and 3' sequences and their constraints
-        cutoff_5_left = CDS_start-CDS_left
-        cutoff_5_right = CDS_start+CDS_right
-        cutoff_3_left = len(seq3)-141
-        cutoff_3_right = None ##### Old: len(seq3)-49
-        
-        ## Cut sequences:
-        part5 = seq5[cutoff_5_left:cutoff_5_right]
-        part3 = seq3[cutoff_3_left:cutoff_3_right]
-
-        ## #FS Constraints:
-        cons_FS_5 = "."*(len(seq5)-100)        
-        cons_FS_3 = "."*(len(seq3))
-        for i in range(len(ranges_t)): # ranges_t[i][0] = Start_index, [3] = hybridDP
-            cons_FS_5 = integrate_into(cons_FS_5, "."*(int(ranges_t[i][0])+len(seq5)-200) + ranges_t[i][3], string.ascii_uppercase[i])
-        for i in range(len(ranges_q)): # ranges_q[i][0] = Start_index, [3] = hybridDP
-            cons_FS_3 = integrate_into(cons_FS_3, "."*(int(ranges_q[i][0])+199) + ranges_q[i][3], string.ascii_lowercase[i])
-        cons_FS_5 = cons_FS_5[cutoff_5_left:cutoff_5_right]
-        cons_FS_3 = cons_FS_3[cutoff_3_left:cutoff_3_right]
-        cons_FS = cons_FS_5 + "xxxxxxx" + cons_FS_3
-        
-        ## #S constraint:
-        if mode == 0:   ## None:    .......xxxxxxx.......
-            cons_S = f"{'.'*len(part5)}xxxxxxx{'.'*len(part3)}"
-        elif mode == 1: ## Classic: <<<<<<<xxxxxxx>>>>>>>
-            cons_S = f"{'<'*len(part5)}xxxxxxx{'>'*len(part3)}"
-        elif mode == 2: ## everything blocked ("x"), except where the cmhit is (there ".")
-            covar_3SL = "x"*(cm_hit_f+199) + "."*(cm_hit_t - cm_hit_f + 1)
-            covar_3SL += "x"*max(0, len(seq3) - len(covar_3SL)) ## Extend remaining dots
-            covar_3SL = covar_3SL[:len(seq3)] ## One specific sequence has cm_t LARGER than the sequence itself so..
-            covar_3SL = covar_3SL[cutoff_3_left:cutoff_3_right]
-            cons_S = f"{(len(part5))*'x'}xxxxxxx{covar_3SL}"
+        part5, part3, cons_S, cons_1, cons_2, cons_FS = build_constraints(
+            seq5, seq3, ranges_t, ranges_q, CDS_start, CDS_left, CDS_right, cm_hit_f, cm_hit_t, mode=mode)
+        if mode == 2:
             skip_FS = True  ## Enforce #FS to be skipped since #S is otherwise ignored
-        elif mode == 3: ## #S constraint using interactions (using the #FS sequence)
-            # Only take C and c if they are nested with A and B
-            cons_S = str(cons_FS)
-            first_A = cons_S.find("A")
-            first_B = cons_S.find("B")
-            first_C = cons_S.find("C")
-            first_a = cons_S.find("a")
-            first_b = cons_S.find("b")
-            first_c = cons_S.find("c")
-            cons_S = cons_S.replace("A", "(").replace("a", ")").replace("B", "(").replace("b", ")")
-            if ((first_C < first_A and first_C < first_B and first_c > first_a and first_c > first_b) or # CAB bac and CBA abc
-               (first_C < first_A and first_C > first_B and first_c > first_a and first_c < first_b) or  # BCA acb
-               (first_C > first_A and first_C < first_B and first_c < first_a and first_c > first_b) or  # ACB bca
-               (first_C > first_A and first_C > first_B and first_c < first_a and first_c < first_b)):   # ABC cba and BAC cab
-                cons_S = cons_S.replace("C", "(").replace("c", ")")
-            else: # C is not nested with A and B so it gets ignored
-                cons_S = cons_S.replace("C", ".").replace("c", ".")
-            #cons_S = cons_S.replace(".", "x")
-            cons_FS = cons_S
-            cons_S = f"{'.'*len(part5)}xxxxxxx{'.'*len(part3)}"
+        elif mode == 3:
             skip_FS = False ## Enforce #FS to be actually used in this mode
-            cons_FS = get_special_combined_constraint(f"{part5}NNNNNNN{part3}", cons_FS)
-        else:
-            raise ValueError("Invalid mode for #S constraint")
-        ## Constraint 1/2:
-        cons_1 = f"{CDS_left*'.'}AAA{(CDS_right-3)*'.'}BBBBBBB{len(part3)*'.'}"
-        cons_2 = f"{CDS_left*'.'}123{(CDS_right-3)*'.'}1234567{len(part3)*'.'}"
-        if not ((cons_FS.count("(") == cons_FS.count(")"))
-           and (cons_FS.count("A") == cons_FS.count("a"))
-           and (cons_FS.count("B") == cons_FS.count("b"))
-           and (cons_FS.count("C") == cons_FS.count("c"))):
-           print(f"FS constraint unbalanced for {row['id']}")
+            ## cons_FS gets completed by get_special_combined_constraints after the loop
+            special_folds[row["id"]] = (f"{part5}NNNNNNN{part3}", cons_FS)
+        if mode != 3:
+            check_fs_balance(row['id'], cons_FS)
 
         # seq_dir["all"].append((f"{row['class']}-{row['id']}", part5, part3, cons_S, cons_1, cons_2, cons_FS))
         if row['class'] != "ISFV":
             seq_dir[row['class']].append([f"{row['class']}-{row['id']}", part5, part3, cons_S, cons_1, cons_2, cons_FS])
+            id_entries[row['id']].append(seq_dir[row['class']][-1])
         else: # Separate cISFV and dISFV
             group_name = row['type'][:-1]
             seq_dir[group_name].append([f"{group_name}-{row['id']}", part5, part3, cons_S, cons_1, cons_2, cons_FS])
+            id_entries[row['id']].append(seq_dir[group_name][-1])
         if row['id'] == "NC_009942.1": ###### TEMPORARY FOR TESTING
             seq_dir[f"single_{row['virus']}"].append([f"{row['virus']}-{row['id']}", part5, part3, cons_S, cons_1, cons_2, cons_FS])
             seq_dir[f"single_{row['virus']}"].append([f"{row['virus']}-{row['id']}a", part5, part3, cons_S, cons_1, cons_2, cons_FS])   
+            id_entries[row['id']] += seq_dir[f"single_{row['virus']}"][-2:]
+    if special_folds: ## All mode 3 folds at once, mapped back to the entries by id
+        for vid, cons_FS in get_special_combined_constraints(special_folds).items():
+            check_fs_balance(vid, cons_FS)
+            for entry in id_entries[vid]:
+                entry[6] = cons_FS
     # Combined alignments
     seq_dir["dISFV+TBFV"] = seq_dir["dISFV"] + seq_dir["TBFV"]
     seq_dir["MBFV+dISFV"] = seq_dir["MBFV"] + seq_dir["dISFV"]
     seq_dir["MBFV+TBFV"] = seq_dir["MBFV"] + seq_dir["TBFV"]
 
-    for seq_class in seq_dir:
-        fasta_file_name = f"{output_path}/locARNA_{seq_class}_input.fa"
-        make_locarna_fasta(seq_dir[seq_class], fasta_file_name, skip_FS=skip_FS)
-        run_mlocarna(fasta_file_name, f"{output_path}/{seq_class}", use_carna, temperature=temperature)
-        run_rnaalifold(f"{output_path}/{seq_class}/results", seq_dir[seq_class], mode=mode, locARNA_input=fasta_file_name, temperature=temperature)
-        run_ps_to_pdf(f"{output_path}/{seq_class}/results/alirna.ps", f"{output_path}/{seq_class}_alirna.pdf")
-        run_ps_to_pdf(f"{output_path}/{seq_class}/results/aln.ps", f"{output_path}/{seq_class}_aln.pdf")
\ No newline at end of file
+    trees = {}
+    if cache is not None and not use_carna:
+        trees = make_guide_trees(seq_dir, output_path, skip_FS, temperature, jobs, cache)
+    workers = max(1, min(jobs, len(seq_dir)))
+    threads = max(1, jobs // workers)  ## --threads share, so that workers * threads <= jobs
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_locarna_group, seq_class, seq_dir[seq_class], output_path,
+                                   use_carna, skip_FS, mode, temperature, threads,
+                                   tree_file=trees.get(seq_class))
+                   for seq_class in seq_dir]
+        for future in futures:
+            future.result()  ## Raise errors of the groups
\ No newline at end of file
@@ -2,9 +2,37 @@ import os
 import sys
 import subprocess
 import math
+import shutil
+import tempfile
 #from Codes.MRRI import MRRIHandler
 import Codes.MRRI_main
+from Codes.tools import tool_cmd, tool_env
+from Codes.alignment import Alignment, load_alignment
+try:
+    import RNA  ## ViennaRNA Python bindings, optional (RNAfold is used otherwise)
+except ImportError:
+    RNA = None
 
+## Scratch directories of the tools, on tmpfs if available
+scratch_root = "/dev/shm" if os.access("/dev/shm", os.W_OK) else None
+consensus_constraint_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "consensus-constraint.R")
+
+
+def scratch_dir():
+    """Temporary working directory of one tool call (removed afterwards).
+    Tools write their side files (e.g. alirna.ps, tmp.fa) there,
+    so several calls can run at the same time.
+    """
+    return tempfile.TemporaryDirectory(prefix="flavi_", dir=scratch_root)
+
+
+def move_into(src, dest):
+    """Moves a file atomically to dest, also from tmpfs to another filesystem."""
+    try:
+        os.replace(src, dest)
+    except OSError:  ## Different filesystems: copy next to dest first
+        shutil.copyfile(src, f"{dest}.tmp")
+        os.replace(f"{dest}.tmp", dest)
 
 def find_all(s, c):
     """Generator that finds and returns the locations 
@@ -54,95 +82,171 @@ def cm_compare(id, seq, cm_file):
     - read sequence from input and compare with cmhit
     - if match, insert respective part from cmhit
     - if not, shift cmhit sequence to the next base
+    The alignment file is parsed only once (see load_alignment).
     """
     #print(id)
-    location = None
-    result_string = ""
-    name_found = False
-    with open(cm_file, "r") as f:
-        for line in f.readlines():
-            if (not name_found) and line.startswith("#=GS") and line.split()[3] == id:
-                name, location = line.split()[1].split("/")
-                name_found = True
-                #print(name, location)
-            elif name_found and line.startswith(name):
-                cm_seq = line.split()[1]
-                cm_seq = cm_seq.upper().replace("U", "T")
-            elif line.startswith("#=GC SS_cons"):
-                align_cons = line.split()[-1]
-            #elif id == "NC_018705.3":
-            #    print(line)
-    #print("AAAAAAAAAA")
-    if not location:
+    alignment = load_alignment(cm_file)
+    row_name = alignment.name_by_description(id)
+    if not row_name:
         print(f"No CM alignment found for {id}")
         return None
-    else:
-        location_start, location_end = location.split("-")
-        cut_seq = seq[int(location_start)+199:]
-        cut_seq_pos = 0
-        for i in range(len(cm_seq)):
-            if cm_seq[i] == cut_seq[cut_seq_pos]:
-                result_string += align_cons[i]
-                cut_seq_pos += 1
-        return result_string
+    name, location = row_name.split("/")
+    cm_seq = alignment.rows[row_name].upper().replace("U", "T")
+    align_cons = alignment.gc["SS_cons"]
+    location_start, location_end = location.split("-")
+    cut_seq = seq[int(location_start)+199:]
+    residues = alignment.residue_columns(row_name)
+    if "".join(cm_seq[i] for i in residues) == cut_seq[:len(residues)]:
+        ## Every residue of the hit matches: take SS_cons at the residue columns
+        return "".join(align_cons[i] for i in residues)
+    result_string = ""
+    cut_seq_pos = 0
+    for i in range(len(cm_seq)):
+        if cm_seq[i] == cut_seq[cut_seq_pos]:
+            result_string += align_cons[i]
+            cut_seq_pos += 1
+    return result_string
 
 
-def run_mlocarna(input_fasta, output_dir, use_carna=False, temperature=18):
+def run_mlocarna(input_fasta, output_dir, use_carna=False, temperature=18, threads=1, tree_file=None):
     """Run mlocarna on a given fasta file.
     
     input_fasta (str): Filepath to a fasta file to apply locarna on
     output_dir (str): Filepath of the resulting CM file
     use_carna (bool): If crossing structures are expected to be in the input use carna
+    threads (int): Number of threads of mlocarna (--threads)
+    tree_file (str): Optional guide tree (Newick), skips the all-vs-all pairwise alignments
     """
     
+    env_name = "carna" if use_carna else "locarna"
     if use_carna:
         print(f"mlocarna(+carna): {input_fasta} `=> {output_dir}")
-        ## Doesnt work: :(
-        conda_base = subprocess.Popen(["conda", "info", "--base"], stdout=subprocess.PIPE)
-        conda_base.wait()
-        carna_loc = list(conda_base.stdout)[0].decode("utf-8").rstrip("\n")
-        carna_loc += "/envs/carna/bin/carna"
-        #carna_loc = "/home/arkanini/miniconda3/envs/carna/bin/carna"
-        cmd = ["conda", "run", "-n", "carna"]
+        carna_loc = tool_cmd("carna")[-1]
     else:
         print(f"mlocarna: {input_fasta} `=> {output_dir}")
-        cmd = ["conda", "run", "-n", "locarna"]
-    cmd += ["mlocarna", input_fasta,
+    cmd = tool_cmd("mlocarna", env_name)
+    cmd += [os.path.abspath(input_fasta),
            #"--indel=-50", # Webserver parameter
            #"--indel-opening=-750", # Webserver parameter
            "--width=3000",
            "--use-ribosum=true",
            "--rnafold-temperature", str(temperature),
-           "--tgtdir", output_dir
+           "--threads", str(threads),
+           "--tgtdir", os.path.abspath(output_dir)
            ]
     if use_carna:
         cmd += [f"--pw-aligner={carna_loc}"]
+    if tree_file:
+        cmd += ["--tree-file", os.path.abspath(tree_file)]
     #print(" ".join(cmd))
     #raise
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    p.wait()
+    with scratch_dir() as tmp_dir:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=tool_env("mlocarna", env_name), cwd=tmp_dir)
+        p.wait()
+
+
+## Options of the pairwise locarna runs, same scoring as the mlocarna runs
+locarna_pair_options = ["--use-ribosum=true"]
+
+
+def run_locarna_pair(fasta_a, fasta_b, temperature=18, cache=None):
+    """Aligns two sequences (with their constraints) with pairwise locarna
+    and returns the alignment score. Scores are stored in the cache, keyed by
+    both inputs, the temperature and the options, so every pair is computed once.
+
+    fasta_a (str): Single sequence locarna input (see make_locarna_fasta) as text
+    fasta_b (str): Second sequence
+    cache (ResultCache): Optional store for the scores
+
+    Output:
+    score (float): locarna score of the pair, None if locarna failed
+    """
+    if cache is not None:
+        key = cache.key("locarna", *sorted([fasta_a, fasta_b]), temperature, *locarna_pair_options)
+        cached = cache.get(key)
+        if cached is not None:
+            return float(cached)
+    with scratch_dir() as tmp_dir:
+        with open(f"{tmp_dir}/a.fa", "w") as f:
+            f.write(fasta_a)
+        with open(f"{tmp_dir}/b.fa", "w") as f:
+            f.write(fasta_b)
+        cmd = tool_cmd("locarna") + [f"{tmp_dir}/a.fa", f"{tmp_dir}/b.fa",
+                                     "--rnafold-temperature", str(temperature)] + locarna_pair_options
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=tool_env("locarna"),
+                             cwd=tmp_dir)
+        stdout, stderr = p.communicate()
+    score = None
+    for line in stdout.decode("utf-8").splitlines():
+        if line.startswith("Score:"):
+            score = float(line.split()[1])
+            break
+    if score is None:
+        print(f"locarna failed for {fasta_a.split()[0]} and {fasta_b.split()[0]}")
+        return None
+    if cache is not None:
+        cache.put(key, str(score))
+    return score
+
+
+def upgma_tree(names, scores):
+    """Builds a guide tree of the sequences by UPGMA on the pairwise scores
+    (higher score = more similar), like mlocarna does.
+
+    names (list): Sequence names
+    scores (dict): frozenset({name_a, name_b}) => score for all pairs
+
+    Output:
+    tree (str): Tree in Newick format
+    """
+    clusters = {name: (name, 1) for name in names} ## Newick of the cluster, size
+    similarity = {key: score for key, score in scores.items()}
+    while len(clusters) > 1:
+        pair = max(similarity, key=similarity.get)
+        a, b = sorted(pair)
+        (tree_a, size_a), (tree_b, size_b) = clusters.pop(a), clusters.pop(b)
+        merged = f"({tree_a},{tree_b})"
+        for other in clusters:
+            similarity[frozenset((merged, other))] = ((size_a * similarity.pop(frozenset((a, other))) +
+                                                       size_b * similarity.pop(frozenset((b, other))))
+                                                      / (size_a + size_b))
+        del similarity[pair]
+        clusters[merged] = (merged, size_a + size_b)
+    return f"{next(iter(clusters.values()))[0]};"
 
 
 def run_consensus_constraint(locARNA_input, locARNA_output):
-    cmd = ["conda", "run", "-n", "r-tidyverse"]
-    cmd += ["Rscript", "--vanilla", "Codes/consensus-constraint.R",
-            "-a", locARNA_output,
-            "-c", locARNA_input,
+    cmd = tool_cmd("Rscript")
+    cmd += ["--vanilla", consensus_constraint_script,
+            "-a", os.path.abspath(locARNA_output),
+            "-c", os.path.abspath(locARNA_input),
             "-t", "FS"
             ]
     #print(" ".join(cmd))
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    p.wait()
-    consensus_constraint = list(p.stdout)[0].decode("utf-8")
+    with scratch_dir() as tmp_dir:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=tool_env("Rscript"), cwd=tmp_dir)
+        consensus_constraint = list(p.stdout)[0].decode("utf-8")
+        p.wait()
     return consensus_constraint
 
 
-def get_modified_s_cons_for_seq(seq_dir_list, locarna_alignment_seq, mode):
+def get_modified_s_cons_for_seq(seq_dir_list, locarna_alignment_seq, mode, alignment=None, name=None):
+    """Projects the #S constraint of a sequence onto its row of the locARNA alignment,
+    gap columns get "." ("x" in mode 2).
+
+    seq_dir_list (list): seq_dir entry without the name (part5, part3, cons_S, ...)
+    locarna_alignment_seq (str): Row of the sequence in the alignment
+    alignment (Alignment): Optional parsed alignment containing the row as name
+    """
     seq = seq_dir_list[0] + "NNNNNNN" + seq_dir_list[1]
     seq = seq.replace("T", "U")
     filler = "."
     if mode == 2:
         filler = "x"
+    if alignment is None:
+        alignment, name = Alignment({"row": locarna_alignment_seq}), "row"
+    if len(seq_dir_list[2]) == len(seq) and alignment.ungapped(name) == seq:
+        return alignment.spread(name, seq_dir_list[2], filler) ## Every residue matches its base
     current_pos = 0
     reached_end = False
     result = ""
@@ -176,35 +280,30 @@ def run_rnaalifold(locARNA_output_dir, seq_dir_entries, mode=0, locARNA_input=""
     if mode == 3:
         constraint = run_consensus_constraint(locARNA_input, locARNA_output)
     else:
-        with open(locARNA_output, "r") as f:
-            for line in f.readlines():
-                split_line = line.split()
-                #print(split_line)
-                if ((mode == 2) and
-                    len(split_line) == 2 and split_line[0] != "#A1"):
-                    new_s_cons = get_modified_s_cons_for_seq(seq_dir_entry_dict[split_line[0]], split_line[1], mode)
-                    seq_dir_entry_dict[split_line[0]].append(new_s_cons)
-                if line.startswith("#A1"):
-                    anchor_seq = line.split()[-1]
-                    s1, s2 = anchor_seq.split("BBBBBBB")
-                    if mode == 0:
-                        constraint = "."*len(s1) + "xxxxxxx" + "."*(len(s2)-1)
-                    elif mode == 1:
-                        constraint = "<"*len(s1) + "xxxxxxx" + ">"*(len(s2)-1)
-                    elif mode == 2:
-                        earliest_pos = math.inf
-                        for key, value in seq_dir_entry_dict.items():
-                            group = key.split("-")[0]
-                            if group in locARNA_output_dir:
-                                cons = value[-1]
-                                cm_pos = cons.find(".")
-                                if cm_pos < earliest_pos:
-                                    earliest_pos = cm_pos
-                        constraint = "x"*earliest_pos + "."*(len(s1)+7+len(s2)-1-earliest_pos)
-                    else:
-                        raise ValueError("Invalid mode for the RNAalifold constraint")
-                    break
-    cmd = ["RNAalifold", locARNA_output,
+        alignment = load_alignment(locARNA_output)
+        if mode == 2:
+            for name, row in alignment.rows.items():
+                new_s_cons = get_modified_s_cons_for_seq(seq_dir_entry_dict[name], row, mode, alignment, name)
+                seq_dir_entry_dict[name].append(new_s_cons)
+        anchor_seq = alignment.annotations["#A1"]
+        s1, s2 = anchor_seq.split("BBBBBBB")
+        if mode == 0:
+            constraint = "."*len(s1) + "xxxxxxx" + "."*(len(s2)-1)
+        elif mode == 1:
+            constraint = "<"*len(s1) + "xxxxxxx" + ">"*(len(s2)-1)
+        elif mode == 2:
+            earliest_pos = math.inf
+            for key, value in seq_dir_entry_dict.items():
+                group = key.split("-")[0]
+                if group in locARNA_output_dir:
+                    cons = value[-1]
+                    cm_pos = cons.find(".")
+                    if cm_pos < earliest_pos:
+                        earliest_pos = cm_pos
+            constraint = "x"*earliest_pos + "."*(len(s1)+7+len(s2)-1-earliest_pos)
+        else:
+            raise ValueError("Invalid mode for the RNAalifold constraint")
+    cmd = tool_cmd("RNAalifold") + [os.path.abspath(locARNA_output),
            "--aln", "--ribosum_scoring",
            "--cfactor", "0.6",
            "--nfactor", "0.5",
@@ -217,18 +316,73 @@ def run_rnaalifold(locARNA_output_dir, seq_dir_entries, mode=0, locARNA_input=""
            ]
     #print(" ".join(cmd))
     #print(constraint)
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.communicate(input=str.encode(constraint)) # Transmit constraints manually
-    p.wait()
-    os.rename("alirna.ps", f"{locARNA_output_dir}/alirna.ps")
-    os.rename("aln.ps", f"{locARNA_output_dir}/aln.ps")
+    with scratch_dir() as tmp_dir: # RNAalifold writes alirna.ps and aln.ps into its working directory
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tmp_dir)
+        p.communicate(input=str.encode(constraint)) # Transmit constraints manually
+        p.wait()
+        move_into(f"{tmp_dir}/alirna.ps", f"{locARNA_output_dir}/alirna.ps")
+        move_into(f"{tmp_dir}/aln.ps", f"{locARNA_output_dir}/aln.ps")
+
+
+def fold_constrained(records, temperature=18.0):
+    """Folds many sequences with hard constraints (like RNAfold -C --noLP).
+    Uses the ViennaRNA Python bindings in-process if they are installed,
+    otherwise a single RNAfold call that reads all records from stdin.
+
+    records (dict): id => (sequence, constraint)
+    temperature (float): Folding temperature
 
+    Output:
+    structures (dict): id => MFE structure
+    """
+    if RNA is not None:
+        md = RNA.md()
+        md.temperature = temperature
+        md.noLP = 1
+        structures = {}
+        for vid, (seq, cons) in records.items():
+            fc = RNA.fold_compound(seq, md)
+            fc.hc_add_from_db(cons, RNA.CONSTRAINT_DB_DEFAULT)
+            structures[vid] = fc.mfe()[0]
+        return structures
+    ## One record per id: >id, sequence, constraint
+    fasta = "".join(f">{vid}\n{seq}\n{cons}\n" for vid, (seq, cons) in records.items())
+    cmd = tool_cmd("RNAfold") + ["-C",
+           "-T", str(temperature),
+           "-t", "0", "--noLP", "--noPS"]
+    with scratch_dir() as tmp_dir:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE, cwd=tmp_dir)
+        stdout, stderr = p.communicate(input=fasta.encode("utf-8"))
+    ## Output per record: >id, sequence, "structure (energy)"
+    structures = {}
+    vid = None
+    lines = stdout.decode("utf-8").splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith(">"):
+            vid = line[1:].split()[0]
+            structures[vid] = lines[i+2].split(" ")[0]
+    return structures
 
-def make_tmp_fasta(seq, cons, output_name):
-    with open(output_name, "w") as f:
-        f.write(f">tmp\n")
-        f.write(f"{seq}\n")
-        f.write(f"{cons}\n")
+
+def get_special_combined_constraints(records):
+    """
+    get_special_combined_constraint for many sequences with one fold_constrained call.
+
+    records (dict): id => (seq, constraint)
+
+    Output:
+    constraints (dict): id => new constraint
+    """
+    tmp_records = {}
+    for vid, (seq, constraint) in records.items():
+        last_pos = constraint.rfind(")") + 1
+        tmp_records[vid] = (seq, "x"*(last_pos)+"."*(len(constraint)-(last_pos)))
+    res_folds = fold_constrained(tmp_records, temperature=18.0)
+    new_constraints = {}
+    for vid, (seq, constraint) in records.items():
+        last_pos = constraint.rfind(")") + 1
+        new_constraints[vid] = constraint[:last_pos] + res_folds[vid][last_pos:]
+    return new_constraints
 
 
 def get_special_combined_constraint(seq, constraint):
@@ -236,35 +390,20 @@ def get_special_combined_constraint(seq, constraint):
     Take constraint
     Find last ")" in it
     Make 2. string where every position up to that ")" including itself is replaced with "x"
-    Create temp fasta of that seq with constraint
-    Run RNAfold with that fasta
+    Fold the seq with that constraint (RNAfold)
     Take the result of that
     Merge it with first constraint 
     (original constraint should only have "." at the end so those are replaced with the new)
     Return that
     """
-    tmp_fasta_name = "tmp.fa"
-    last_pos = constraint.rfind(")") + 1
-    tmp_cons = "x"*(last_pos)+"."*(len(constraint)-(last_pos))
-    make_tmp_fasta(seq, tmp_cons, tmp_fasta_name) # Make temporary fasta file 
-    cmd = ["RNAfold", tmp_fasta_name, "-C",
-           "-T", "18.0", 
-           "-t", "0", "--noLP"]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    ## get result of RNAfold
-    ## element 2 has structure b'structure (energy)' => we cut off the energy
-    res_fold = list(p.stdout)[2].decode("utf-8").split(" ")[0]
-    new_constraint = constraint[:last_pos] + res_fold[last_pos:]
-    #print(constraint)
-    #print(tmp_cons)
-    #print(new_constraint)
-    #raise
-    return new_constraint
+    return get_special_combined_constraints({"tmp": (seq, constraint)})["tmp"]
 
 
 def run_ps_to_pdf(ps_file, output):
     print(f"ps2pdf: {ps_file} `=> {output}")
-    cmd = ["ps2pdf", "-dEPSCrop", ps_file, output]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    p.wait()
+    with scratch_dir() as tmp_dir:
+        cmd = tool_cmd("ps2pdf") + ["-dEPSCrop", os.path.abspath(ps_file), f"{tmp_dir}/out.pdf"]
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=tmp_dir)
+        p.wait()
+        if os.path.isfile(f"{tmp_dir}/out.pdf"):
+            move_into(f"{tmp_dir}/out.pdf", output)
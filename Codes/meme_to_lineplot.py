@@ -8,16 +8,30 @@ import numpy as np
 import math
 from collections import defaultdict
 from Codes.evaluation import draw_lineplots
+from Codes.plotting import run_plot_jobs
 
 
-def meme_to_lineplot(df, extra_bases_roi, meme_output):
+def meme_to_lineplot(df, extra_bases_roi, meme_output, interactions=None, workers=1):
+    """Draws the MEME lineplot of every virus class (see meme_lineplot_jobs).
+
+    workers (int): Number of processes drawing the plots (see run_plot_jobs)
+
+    Output:
+    outputs (list): Paths of the plots of every class
+    """
+    return run_plot_jobs(meme_lineplot_jobs(df, extra_bases_roi, meme_output, interactions), workers)
+
+
+def meme_lineplot_jobs(df, extra_bases_roi, meme_output, interactions=None):
     """Improvised function to extract relevant information from meme output text files
     to add them to a lineplot similar to the one from evaluation.py.
+    Returns the draw_lineplots jobs of all virus classes for run_plot_jobs.
     Noteworth variables:
     mega_dict(dict): A dictionary of virus classes where each entry is a
                      dictionary of the 4 sites and their respective motifs
                      locations for each of the sequences as tuples.
                      {"class": {"site": {"id" : (motif_start, motif_end)}}}
+    interactions (df): Optional interaction table, passed on to draw_lineplots
     """
     virus_classes = ("MBFV", "TBFV", "ISFV", "NKV")
     mega_dict = defaultdict(dict)
@@ -40,23 +54,39 @@ def meme_to_lineplot(df, extra_bases_roi, meme_output):
                 break
         for virus_class in virus_classes:
             mega_dict[virus_class][site] = d[virus_class]
+    jobs = []
     for virus_class in virus_classes:
         meme_sites = mega_dict[virus_class]
-        draw_lineplots(df.loc[df["class"] == virus_class],
-                       extra_bases_roi,
-                       f"{meme_output}/MEME_{virus_class}.png", subopt_mode=True, meme_sites=meme_sites) #virus_class ? 
+        jobs.append((draw_lineplots, (df.loc[df["class"] == virus_class],
+                                      extra_bases_roi,
+                                      f"{meme_output}/MEME_{virus_class}.png"),
+                     dict(subopt_mode=True, meme_sites=meme_sites, interactions=interactions))) #virus_class ? 
+    return jobs
  
     
-def glam2_to_lineplot(df, extra_bases_roi, meme_output):
+def glam2_to_lineplot(df, extra_bases_roi, meme_output, interactions=None, workers=1):
+    """Draws the GLAM2 lineplot of every virus class (see glam2_lineplot_jobs).
+
+    workers (int): Number of processes drawing the plots (see run_plot_jobs)
+
+    Output:
+    outputs (list): Paths of the plots of every class
+    """
+    return run_plot_jobs(glam2_lineplot_jobs(df, extra_bases_roi, meme_output, interactions), workers)
+
+
+def glam2_lineplot_jobs(df, extra_bases_roi, meme_output, interactions=None):
     """
     Improvised function to extract relevant information from glam2 output text files
     to add them to a lineplot similar to the one from evaluation.py.
+    Returns the draw_lineplots jobs of all virus classes for run_plot_jobs.
     Note: This will literally only work with the super specific output file by the MEME Suite webserver.
     Noteworth variables:
     mega_dict(dict): A dictionary of virus classes where each entry is a
                      dictionary of the 4 sites and their respective motifs
                      locations for each of the sequences as tuples.
                      {"class": {"site": {"id" : (motif_start, motif_end)}}}
+    interactions (df): Optional interaction table, passed on to draw_lineplots
     """
     from Bio import SeqIO ### ...
     virus_classes = ("MBFV", "TBFV", "ISFV", "NKV")
@@ -83,8 +113,11 @@ def glam2_to_lineplot(df, extra_bases_roi, meme_output):
                 break
         for virus_class in virus_classes:
             mega_dict[virus_class][site] = d[virus_class]
+    jobs = []
     for virus_class in virus_classes:
         meme_sites = mega_dict[virus_class]
-        draw_lineplots(df.loc[df["class"] == virus_class],
-                       extra_bases_roi,
-                       f"{meme_output}/GLAM2_{virus_class}.png", subopt_mode=True, meme_sites=meme_sites)
\ No newline at end of file
+        jobs.append((draw_lineplots, (df.loc[df["class"] == virus_class],
+                                      extra_bases_roi,
+                                      f"{meme_output}/GLAM2_{virus_class}.png"),
+                     dict(subopt_mode=True, meme_sites=meme_sites, interactions=interactions)))
+    return jobs
\ No newline at end of file
@@ -1,6 +1,10 @@
 import pandas as pd
 import os
-from Bio import SeqIO
+import time
+import hashlib
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 def read_out_bed6_data(file):
     """
@@ -8,9 +12,9 @@ def read_out_bed6_data(file):
     
     file (str): Filepath to the bed6 file
     """
-    f = open(file, "r")
     UTR5len, CDSlen, UTR3len = None, None, None
-    lines = f.readlines()
+    with open(file, "r") as f:
+        lines = f.readlines()
     if len(lines) == 3: ## Filter files without UTR data
         UTR5end = lines[0].split("\t")[2]
         CDSend = lines[1].split("\t")[2]
@@ -33,33 +37,265 @@ def write_static_parameters(static_d, static_param_path):
             f.write(f"{param} = {value} \n")
 
 
-def create_parameter_table(database_path, extra_bases, output):
+def build_fasta_index(fasta):
+    """Scans the first record of a FASTA file once and returns its .fai entry
+    (like samtools faidx). The sequence itself is never kept in memory.
+
+    fasta (str): Filepath to the FASTA file
+
+    Output:
+    index (tuple): (name, length, offset, line_bases, line_bytes)
+    """
+    with open(fasta, "rb") as f:
+        name = f.readline()[1:].split()[0].decode("utf-8")
+        offset = f.tell()
+        length = 0
+        line_bases, line_bytes = 0, 0
+        for line in f:
+            if line.startswith(b">"):
+                break
+            bases = len(line.rstrip(b"\r\n"))
+            if not line_bases:
+                line_bases, line_bytes = bases, len(line)
+            length += bases
+    return name, length, offset, line_bases, line_bytes
+
+
+def read_fasta_index(fasta, index_dir=None):
+    """Returns the .fai entry of a FASTA file.
+    The entry is kept in {index_dir}/{hash of the FASTA path}.fai together with the
+    size and mtime of the FASTA, and built again if they changed. The database
+    itself is never written to.
+
+    fasta (str): Filepath to the FASTA file
+    index_dir (str): Directory of the stored entries (e.g. Results/.cache/fasta_index),
+                     None builds the entry without storing it
+    """
+    if index_dir is None:
+        return build_fasta_index(fasta)
+    stat = os.stat(fasta)
+    fai = f"{index_dir}/{hashlib.sha256(os.path.abspath(fasta).encode('utf-8')).hexdigest()}.fai"
+    try:
+        with open(fai, "r") as f:
+            name, length, offset, line_bases, line_bytes, size, mtime_ns = f.readline().split("\t")
+        if (int(size), int(mtime_ns)) == (stat.st_size, stat.st_mtime_ns):
+            return name, int(length), int(offset), int(line_bases), int(line_bytes)
+    except (OSError, ValueError):
+        pass  ## No or unreadable entry
+    index = build_fasta_index(fasta)
+    os.makedirs(index_dir, exist_ok=True)
+    with open(f"{fai}.{os.getpid()}.{threading.get_ident()}.tmp", "w") as f:
+        f.write("\t".join(str(i) for i in (*index, stat.st_size, stat.st_mtime_ns)) + "\n")
+    os.replace(f"{fai}.{os.getpid()}.{threading.get_ident()}.tmp", fai)
+    return index
+
+
+def fetch_fasta_region(f, index, start, end):
+    """Reads the bases [start, end) of the first record of an open FASTA file
+    by seeking to them.
+
+    f (open file): FASTA file opened in binary mode
+    index (tuple): .fai entry as returned by read_fasta_index
+    start (int): 0-based start position
+    end (int): 0-based end position (exclusive)
+    """
+    name, length, offset, line_bases, line_bytes = index
+    start, end = max(0, start), min(length, end)
+    if start >= end:
+        return ""
+    def byte_pos(i):
+        return offset + (i // line_bases) * line_bytes + i % line_bases
+    f.seek(byte_pos(start))
+    data = f.read(byte_pos(end - 1) - byte_pos(start) + 1)
+    return data.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")
+
+
+def read_utr_sequences(fasta, UTR5len, UTR3len, extra_bases, index_dir=None):
+    """Reads only the 5' and 3' ends of a genome that are needed for IntaRNA.
+
+    fasta (str): Filepath to the genome FASTA file
+    UTR5len (int): Length of the 5'UTR
+    UTR3len (int): Length of the 3'UTR
+    extra_bases (int): Amount of extra bases of the CDS on each side
+    index_dir (str): Where the FASTA index is kept (see read_fasta_index)
+
+    Output:
+    seq5 (str): 5'UTR + extra_bases of the CDS
+    seq3 (str): extra_bases of the CDS + 3'UTR
+    """
+    index = read_fasta_index(fasta, index_dir)
+    length = index[1]
+    with open(fasta, "rb") as f:
+        seq5 = fetch_fasta_region(f, index, 0, UTR5len+extra_bases)
+        seq3 = fetch_fasta_region(f, index, length-UTR3len-extra_bases, length)
+    return seq5, seq3
+
+
+def file_hash(path):
+    """SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """Reads the manifest written by create_parameter_table.
+
+    Output:
+    manifest (dict): path => (mtime_ns, size, hash, vid, extra_bases)
+    """
+    if not os.path.isfile(manifest_path):
+        return {}
+    manifest = pd.read_csv(manifest_path, dtype={"mtime_ns": "int64", "size": "int64", "hash": str,
+                                                 "vid": str, "extra_bases": "int64"})
+    if "mtime_ns" not in manifest.columns: ## Written by an older version, read everything again
+        return {}
+    return {row.path: (int(row.mtime_ns), int(row.size), row.hash, row.vid, int(row.extra_bases))
+            for row in manifest.itertuples()}
+
+
+def write_manifest(manifest, manifest_path):
+    ## mtime is stored as integer nanoseconds, a float would not survive the CSV round trip
+    columns = ["mtime_ns", "size", "hash", "vid", "extra_bases"]
+    df = pd.DataFrame.from_dict(manifest, orient="index", columns=columns)
+    df.to_csv(manifest_path, index_label="path")
+
+
+def manifest_entry(path, vid, extra_bases, old_entry, hash_content=True):
+    """Returns the manifest entry of a file and whether it changed since old_entry.
+    The file is only hashed if its mtime or size differ from the old entry.
+
+    hash_content (bool): If False, the file is never hashed and any change
+                         of mtime or size counts as a change (for the large FASTAs)
+    """
+    stat = os.stat(path)
+    if old_entry and (old_entry[0], old_entry[1], old_entry[4]) == (stat.st_mtime_ns, stat.st_size, extra_bases):
+        return old_entry, False
+    if not hash_content:
+        return (stat.st_mtime_ns, stat.st_size, "", vid, extra_bases), True
+    digest = file_hash(path)
+    changed = (not old_entry) or old_entry[2] != digest or old_entry[4] != extra_bases
+    return (stat.st_mtime_ns, stat.st_size, digest, vid, extra_bases), changed
+
+
+def scan_accession(root, vid, extra_bases, old_manifest, index_dir=None):
+    """Checks one accession of the database against the manifest and
+    reads it if it is new or changed.
+
+    root (str): Directory of the accession
+    vid (str): Accession id, the files are {root}/{vid}.bed6 and {root}/{vid}.fa
+    old_manifest (dict): Manifest of the last run (see read_manifest)
+    index_dir (str): Where the FASTA indices are kept (see read_fasta_index)
+
+    Output:
+    entries (dict): New manifest entries of both files
+    changed (bool): True if the accession was read again
+    lengths (tuple): (UTR5len, CDSlen, UTR3len), all None if not read or without UTR data
+    seqs (tuple): (seq5, seq3), None if not read
+    """
+    entries = {}
+    changed = False
+    for path in (f"{root}/{vid}.bed6", f"{root}/{vid}.fa"):
+        entries[path], path_changed = manifest_entry(path, vid, extra_bases, old_manifest.get(path),
+                                                     hash_content=path.endswith(".bed6"))
+        changed = changed or path_changed
+    if not changed:
+        return entries, False, (None, None, None), None
+    lengths = read_out_bed6_data(f"{root}/{vid}.bed6")
+    if lengths[0] is None: # File had no UTR data
+        return entries, True, lengths, None
+    seqs = read_utr_sequences(f"{root}/{vid}.fa", lengths[0], lengths[2], extra_bases, index_dir)
+    return entries, True, lengths, seqs
+
+
+def scan_database(database_path, extra_bases, old_manifest={}, workers=8, index_dir=None):
+    """Generator that scans a database for .bed6 files and reads the accessions
+    concurrently in a pool of `workers` threads (the bed6 files are parsed there
+    as well, they only have 3 lines). Results are yielded as soon as they are
+    ready, in the order of os.walk. Prints the throughput at the end.
+
+    database_path (str): Path to the directories of the fasta files.
+    extra_bases (int): Amount of extra bases of the CDS, that were given to IntaRNA.
+    old_manifest (dict): Manifest of the last run, unchanged accessions are not read
+    workers (int): Number of threads reading the accessions
+    index_dir (str): Where the FASTA indices are kept (see read_fasta_index)
+
+    Yields:
+    (vid, class, type, virus, UTR5len, CDSlen, UTR3len, seq5, seq3), entries, changed
+    where lengths and sequences are None for unchanged accessions (see scan_accession)
+    """
+    start_time = time.time()
+    n_scanned = 0
+    n_read = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = collections.deque() ## Bounded window of running scans, keeps the order
+        for root, dirs, files in os.walk(database_path):
+            for file in files:
+                if file.endswith(".bed6"):
+                    # This split will only work with a database built like the given..
+                    vclass, vtype, virus = root.split("/")[-3:]
+                    split_name = file.split(".")[:-1]
+                    vid = ".".join(split_name)
+                    future = pool.submit(scan_accession, root, vid, extra_bases, old_manifest, index_dir)
+                    pending.append(((vid, vclass, vtype, virus), future))
+                    while len(pending) > 4*max(1, workers) or (pending and pending[0][1].done()):
+                        info, future = pending.popleft()
+                        entries, changed, lengths, seqs = future.result()
+                        n_scanned += 1
+                        n_read += changed
+                        yield (*info, *lengths, *(seqs or (None, None))), entries, changed
+        while pending:
+            info, future = pending.popleft()
+            entries, changed, lengths, seqs = future.result()
+            n_scanned += 1
+            n_read += changed
+            yield (*info, *lengths, *(seqs or (None, None))), entries, changed
+    seconds = max(time.time() - start_time, 1e-9)
+    print(f"Scanned {n_scanned} accessions ({n_read} read) in {seconds:.2f}s "
+          f"({n_scanned/seconds:.1f} accessions/s)")
+
+
+def create_parameter_table(database_path, extra_bases, output, incremental=True,
+                           workers=8, index_dir=None):
     """Scans a given directory for .bed6 files and extracts their information.
+    A manifest of all read files (path, mtime_ns, size, hash) is saved next to
+    the output, the FASTAs are compared by mtime and size only (never hashed).
+    With incremental=True, only accessions whose .bed6 or .fa changed since
+    the last run are read again, all others are taken from the existing table.
     
     database_path (str): Path to the directories of the fasta files.
     extra_bases (int): Amount of extra bases of the CDS, that were given to IntaRNA.
     output (str): Where and as what to save the output
+    incremental (bool): If False, the whole database is read again
+    workers (int): Number of threads reading the database (see scan_database)
+    index_dir (str): Where the FASTA indices are kept, e.g. Results/.cache/fasta_index
+                     (see read_fasta_index). The database is never written to
     """
+    manifest_path = f"{output}.manifest"
+    old_manifest = {}
+    old_table = pd.DataFrame()
+    if incremental and os.path.isfile(output):
+        old_manifest = read_manifest(manifest_path)
+        old_table = pd.read_csv(output, index_col="id")
+    manifest = {}
     d = {}
-    for root, dirs, files in os.walk(database_path):
-        for file in files:
-            if file.endswith(".bed6"):
-                # This split will only work with a database built like the given..
-                vclass, vtype, virus = root.split("/")[-3:]
-                split_name = file.split(".")[:-1]
-                vid = ".".join(split_name)
-                UTR5len, CDSlen, UTR3len = read_out_bed6_data(f"{root}/{file}")
-                if UTR5len is None: # File had no UTR data
-                    continue
-                DNA = SeqIO.read(f"{root}/{vid}.fa", "fasta")
-                # Taking "[0]" will cause issues should we ever get .fa
-                # files with more than 1 sequence (shouldnt happen I think?)
-                seq5 = str(DNA.seq[:UTR5len+extra_bases])
-                seq3 = str(DNA.seq[-UTR3len-extra_bases:])
-                d[vid] = [vclass, vtype, virus, UTR5len, CDSlen, UTR3len, seq5, seq3]
+    for record, entries, changed in scan_database(database_path, extra_bases, old_manifest,
+                                                  workers, index_dir):
+        vid, vclass, vtype, virus, UTR5len, CDSlen, UTR3len, seq5, seq3 = record
+        manifest.update(entries)
+        if not changed:
+            if vid in old_table.index:
+                d[vid] = [vclass, vtype, virus] + list(old_table.loc[vid, ["UTR5len", "CDSlen", "UTR3len", "seq5", "seq3"]])
+            continue # Unchanged (also if it had no UTR data last time)
+        if UTR5len is None: # File had no UTR data
+            continue
+        d[vid] = [vclass, vtype, virus, UTR5len, CDSlen, UTR3len, seq5, seq3]
 
     columns = ["class", "type", "virus", "UTR5len", "CDSlen", "UTR3len", "seq5", "seq3"]
     df = pd.DataFrame(d)
     df.index = pd.Index(columns, name="id")
     df = df.T
     df.to_csv(output, index_label="id")
+    write_manifest(manifest, manifest_path)
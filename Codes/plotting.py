@@ -0,0 +1,42 @@
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def warm_up_plotting():
+    """Initializer of the plotting processes. Selects the non-interactive Agg backend,
+    imports matplotlib/seaborn and draws one empty figure (fonts, style), so the
+    first job of a process does not pay for it.
+    The darkgrid style is set like draw_lineplots leaves it for the plots after it.
+    """
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn
+    plt.style.use("seaborn-v0_8-darkgrid")
+    fig = plt.figure()
+    fig.text(0.5, 0.5, "warm up")
+    fig.canvas.draw()
+    plt.close(fig)
+
+
+def run_plot_job(function, args, kwargs):
+    """Runs one plotting function, returns its output paths."""
+    return function(*args, **kwargs)
+
+
+def run_plot_jobs(jobs, workers=1):
+    """Renders independent figures in a pool of processes (Agg rendering holds the GIL,
+    so threads would not help).
+
+    jobs (list): (function, args, kwargs) of plotting functions that return their output paths,
+                 e.g. draw_lineplots or plot_energy_histos. Arguments must be picklable
+    workers (int): Number of processes, with 1 the jobs run in this process
+
+    Output:
+    outputs (list): Output paths of every job, in the order of the jobs
+    """
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [run_plot_job(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_up_plotting) as executor:
+        futures = [executor.submit(run_plot_job, *job) for job in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import shutil
+import subprocess
+import functools
+
+
+## Conda environment of the tools that are not installed in the main environment
+tool_environments = {"mlocarna": "locarna",
+                     "locarna": "locarna",
+                     "carna": "carna",
+                     "Rscript": "r-tidyverse",
+                     }
+tools = ["IntaRNA", "mlocarna", "locarna", "carna", "RNAalifold", "RNAfold",
+         "cmbuild", "cmcalibrate", "cmsearch", "Rscript", "ps2pdf"]
+
+
+@functools.lru_cache(maxsize=None)
+def conda_base():
+    """Returns the base directory of conda (conda info --base) or None without conda.
+    Only asked once per run.
+    """
+    if os.environ.get("CONDA_EXE"):  ## Set by conda activate, saves starting conda
+        return os.path.dirname(os.path.dirname(os.environ["CONDA_EXE"]))
+    try:
+        p = subprocess.run(["conda", "info", "--base"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    return p.stdout.decode("utf-8").strip() or None
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_tool(tool, env_name=None):
+    """Finds the binary of a tool once.
+    Tools of a conda environment (see tool_environments) are taken from
+    {conda base}/envs/{env}/bin and get that directory first in their PATH,
+    like conda run would do. All others are searched in the PATH.
+
+    tool (str): Name of the binary
+    env_name (str): Conda environment to take the tool from, defaults to tool_environments
+
+    Output:
+    cmd (list): Command prefix to run the tool. Falls back to
+                conda run -n {env} {tool} or the bare name if no binary was found
+    env (dict): Environment variables for the tool, None for the current environment
+    """
+    env_name = env_name or tool_environments.get(tool)
+    if env_name is None:
+        return [shutil.which(tool) or tool], None
+    base = conda_base()
+    prefix = f"{base}/envs/{env_name}" if base else None
+    if prefix and os.access(f"{prefix}/bin/{tool}", os.X_OK):
+        env = dict(os.environ)
+        env["PATH"] = f"{prefix}/bin{os.pathsep}{env.get('PATH', '')}"
+        env["CONDA_PREFIX"] = prefix
+        env["CONDA_DEFAULT_ENV"] = env_name
+        return [f"{prefix}/bin/{tool}"], env
+    return ["conda", "run", "-n", env_name, tool], None
+
+
+def tool_cmd(tool, env_name=None):
+    """Command prefix (list) to run a tool, see resolve_tool."""
+    return list(resolve_tool(tool, env_name)[0])
+
+
+def tool_env(tool, env_name=None):
+    """Environment variables to run a tool with (None: current environment), see resolve_tool."""
+    return resolve_tool(tool, env_name)[1]
+
+
+def resolve_tools():
+    """Resolves all tools at startup and reports the ones that were not found."""
+    for tool in tools:
+        cmd = tool_cmd(tool)
+        if cmd[0] == "conda" or not os.path.isabs(cmd[0]):
+            print(f"{tool}: no binary found, using {' '.join(cmd)}")
+
+
+def benchmark_startup(tool="mlocarna", args=["--version"], repeats=5):
+    """Compares the startup time of running a tool via conda run and directly.
+
+    tool (str): Tool of tool_environments to start
+    args (list): Arguments of the cheap call that is timed
+    repeats (int): Number of calls per variant
+
+    Output:
+    times (dict): "conda run"/"direct" => mean seconds per call
+    """
+    variants = {"conda run": (["conda", "run", "-n", tool_environments.get(tool, "base"), tool], None),
+                "direct": resolve_tool(tool)}
+    times = {}
+    for variant, (cmd, env) in variants.items():
+        start = time.perf_counter()
+        for _ in range(repeats):
+            subprocess.run(cmd + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        times[variant] = (time.perf_counter() - start) / repeats
+        print(f"{tool} ({variant}): {times[variant]:.3f}s per call")
+    return times
+
+
+if __name__ == "__main__":
+    for tool in sys.argv[1:] or list(tool_environments):
+        benchmark_startup(tool)
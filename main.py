@@ -4,17 +4,21 @@ from Codes.intarna import main_intarna, main_mrri
 from Codes.covariance import create_cms, cm_search
 from Codes.meme import get_meme_sequences
 ##from Codes.locarna import main_locarna
-from Codes.meme_to_lineplot import meme_to_lineplot, glam2_to_lineplot
+from Codes.meme_to_lineplot import meme_lineplot_jobs, glam2_lineplot_jobs
+from Codes.plotting import run_plot_jobs
 from Codes.locarna import main_locarna
 from Codes.cds_to_protein import cds_to_proteins
 from Codes.energy_histos import plot_energy_histos
+from Codes.cache import ResultCache
+from Codes.interaction_store import load_interactions
+from Codes.tools import resolve_tools
 import pandas as pd
 import os
 
 tasks = { # Note: You cannot run later tasks without running the earlier ones at least once.
         "create_parameter_tables" : 0,
         "run_IntaRNA"             : 0,
-        "CREATE_CMs"              : 0, ##!## Calibrating takes very long. Do not set to true unless new data.
+        "CREATE_CMs"              : 0, ##!## Calibrating takes very long. Only changed alignments are recalibrated.
         "run_CM_search"           : 0,
         "draw_IntaRNA_plots"      : 1,
         "MEME+GLAM2_prep"         : 0, ## Prepare files so they can be used for the MEME suite
@@ -40,6 +44,7 @@ static_param_path = "Data/static_parameter.cfg"
 parameter_table_file = "Data/parameter_table.csv"
 raw_IntaRNA_output = f"{results}/IntaRNA_raw_output.txt"
 IntaRNA_output = f"{results}/IntaRNA_output.csv"
+IntaRNA_interactions = f"{results}/IntaRNA_interactions" # Long format table of predictions_t/predictions_q
 
 ## Input Covariance Model Paths:
 stockholm_directory = "Data/Flavivirus_Stockholm"
@@ -54,11 +59,17 @@ raw_MRRI_output_1 = f"{results}/MRRI_raw_output_1.txt"
 raw_MRRI_output_2 = f"{results}/MRRI_raw_output_2.txt"
 mrri_file_path_1 = f"{results}/MRRI_output_1.csv"
 mrri_file_path_2 = f"{results}/MRRI_output_2.csv"
+mrri_interactions_1 = f"{results}/MRRI_interactions_1"
+mrri_interactions_2 = f"{results}/MRRI_interactions_2"
 output_loc_mmri_path_mode_2 = f"{results}/locARNA_with_MRRI_only_cm_pos"
 output_loc_mmri_path_mode_3 = f"{results}/locARNA_with_MRRI_only_inter"
 output_loc_mmri_path_carna = f"{results}/locARNA_with_MRRI_crossing"
 mrri_lineplot_path_1 = f"{results}/interaction_lineplot_MRRI_1.png"
 mrri_lineplot_path_2 = f"{results}/interaction_lineplot_MRRI_2.png"
+mrri_max_k = 3 # Maximal number of MRRI sites per genome, None: until converged
+mrri_max_energy = None # Sites with a higher E_hybrid end the MRRI search, None: no limit
+mrri_stop_on_overlap = False # A site overlapping an earlier one ends the MRRI search
+mrri_stop_on_worse = False # A site with a higher E_hybrid than the last one ends the MRRI search
 
 ## Outputs
 energy_histo = f"{results}/old_energy_histo.png"
@@ -68,11 +79,18 @@ meme_output = f"{results}/MEME"
 locarna_output = f"{results}/locARNA"
 amino_acids_output = f"{results}/AminoAcids.fa"
 
+## Cache for IntaRNA/MRRI results (unchanged calls are not recomputed):
+cache_dir = f"{results}/.cache"
+cache_max_bytes = 2*1024**3 # Least recently used results are removed above this size
+
 ## Static Parameters
 extra_bases = 200
 extra_bases_roi = 100
 outNumber = 4 # Allow n-1 subops, must be at least 1
 temperature = 18
+jobs = os.cpu_count() # Number of external processes (e.g. IntaRNA) running at the same time
+cm_search_combined = False # One cmsearch process per sequence file (still one scan per CM, see cm_search)
+cm_calibrate_mpi = False # Calibrate CMs with cmcalibrate --mpi (needs Infernal built with MPI)
 
 ## Region for locARNA
 CDS_left = 40
@@ -91,56 +109,75 @@ static_d = {"energyVRNA": "Data/rna_andronescu2007.par",
 
 
 if __name__ == "__main__":
+    resolve_tools() # Find all external tools once, instead of conda run per call
     if tasks["create_parameter_tables"]:
         write_static_parameters(static_d, static_param_path)
-        create_parameter_table(database_path, extra_bases, parameter_table_file)
+        create_parameter_table(database_path, extra_bases, parameter_table_file, workers=jobs,
+                               index_dir=f"{cache_dir}/fasta_index")
     if tasks["run_IntaRNA"]:
         main_intarna(static_param_path, extra_bases, extra_bases_roi,
                      parameter_table_file, IntaRNA_output, raw_IntaRNA_output,
-                     outNumber)
-    if tasks["CREATE_CMs"]:  ## Do not execute unless new data.
-        create_cms(stockholm_directory, covariance_dir)
+                     outNumber, jobs=jobs, cache=ResultCache(f"{cache_dir}/IntaRNA", cache_max_bytes),
+                     interactions_path=IntaRNA_interactions)
+    if tasks["CREATE_CMs"]:  ## Unchanged models are skipped (see {covariance_dir}.manifest)
+        create_cms(stockholm_directory, covariance_dir, jobs=jobs, mpi=cm_calibrate_mpi)
     if tasks["run_CM_search"]:
         df = pd.read_csv(IntaRNA_output)
-        cm_search(df, covariance_dir, database_path, cm_output_dir, cm_search_file)
+        cm_search(df, covariance_dir, database_path, cm_output_dir, cm_search_file, jobs=jobs,
+                  combined=cm_search_combined)
     if tasks["draw_IntaRNA_plots"]:
         df = pd.read_csv(cm_search_file)
-        draw_lineplots(df, extra_bases_roi, lineplot_output, subopt_mode=True)
+        draw_lineplots(df, extra_bases_roi, lineplot_output, subopt_mode=True,
+                       interactions=load_interactions(IntaRNA_interactions, missing_ok=True,
+                                                    source_csv=IntaRNA_output))
     if tasks["MEME+GLAM2_prep"]:
         get_meme_sequences(cm_search_file, meme_output)
     if tasks["run_locARNA"]:
-        main_locarna(IntaRNA_output, cm_search_file, locarna_output, CDS_left, CDS_right, CMHit_left, CMHit_right)
+        main_locarna(IntaRNA_output, cm_search_file, locarna_output, CDS_left, CDS_right, CMHit_left, CMHit_right,
+                     interactions_path=IntaRNA_interactions, jobs=jobs,
+                     cache=ResultCache(f"{cache_dir}/locarna", cache_max_bytes))
     if tasks["run_MRRI_1"]:
         param_mode = 1 # decides the region of interest for MRRI
-        main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_roi, mrri_file_path_1, raw_MRRI_output_1, param_mode)
+        main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_roi, mrri_file_path_1, raw_MRRI_output_1, param_mode,
+                  cache=ResultCache(f"{cache_dir}/IntaRNA", cache_max_bytes), interactions_path=mrri_interactions_1, jobs=jobs,
+                  max_k=mrri_max_k, max_energy=mrri_max_energy,
+                  stop_on_overlap=mrri_stop_on_overlap, stop_on_worse=mrri_stop_on_worse)
     if tasks["run_MRRI_2"]:
         param_mode = 2 # decides the region of interest for MRRI
-        main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_roi, mrri_file_path_2, raw_MRRI_output_2, param_mode)
+        main_mrri(parameter_table_file, static_param_path, extra_bases, extra_bases_roi, mrri_file_path_2, raw_MRRI_output_2, param_mode,
+                  cache=ResultCache(f"{cache_dir}/IntaRNA", cache_max_bytes), interactions_path=mrri_interactions_2, jobs=jobs,
+                  max_k=mrri_max_k, max_energy=mrri_max_energy,
+                  stop_on_overlap=mrri_stop_on_overlap, stop_on_worse=mrri_stop_on_worse)
     if tasks["locARNA+MRRI"]:
-        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_mode_2, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=False, mode=2, temperature=temperature)
-        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_mode_3, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=False, mode=3, temperature=temperature)
+        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_mode_2, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=False, mode=2, temperature=temperature, interactions_path=mrri_interactions_2, jobs=jobs, cache=ResultCache(f"{cache_dir}/locarna", cache_max_bytes))
+        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_mode_3, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=False, mode=3, temperature=temperature, interactions_path=mrri_interactions_2, jobs=jobs, cache=ResultCache(f"{cache_dir}/locarna", cache_max_bytes))
     if tasks["locARNA+MRRI+CARNA"]:
-        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_carna, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=True, mode=1, temperature=temperature)
+        main_locarna(mrri_file_path_2, cm_search_file, output_loc_mmri_path_carna, CDS_left, CDS_right, CMHit_left, CMHit_right, use_carna=True, mode=1, temperature=temperature, interactions_path=mrri_interactions_2, jobs=jobs)
     if tasks["draw_MRRI_plots"] or tasks["MEME+GLAM2_lineplots"]:
+        plot_jobs = [] # Independent figures, drawn in a pool of processes at the end
         cmdf = pd.read_csv(cm_search_file)
         if os.path.isfile(mrri_file_path_1):
             mrri_df_1 = pd.read_csv(mrri_file_path_1)
+            mrri_inter_1 = load_interactions(mrri_interactions_1, missing_ok=True, source_csv=mrri_file_path_1)
             mrri_df_1["cm_hit_f"] = pd.Series(cmdf["cm_hit_f"])
             mrri_df_1["cm_hit_t"] = pd.Series(cmdf["cm_hit_t"])
             mrri_df_1["cm_hit_src"] = pd.Series(cmdf["cm_hit_src"])
             if tasks["draw_MRRI_plots"]:
-                draw_lineplots(mrri_df_1, extra_bases_roi, mrri_lineplot_path_1)
+                plot_jobs.append((draw_lineplots, (mrri_df_1, extra_bases_roi, mrri_lineplot_path_1), dict(interactions=mrri_inter_1)))
         if os.path.isfile(mrri_file_path_2):
             mrri_df_2 = pd.read_csv(mrri_file_path_2)
+            mrri_inter_2 = load_interactions(mrri_interactions_2, missing_ok=True, source_csv=mrri_file_path_2)
             mrri_df_2["cm_hit_f"] = pd.Series(cmdf["cm_hit_f"])
             mrri_df_2["cm_hit_t"] = pd.Series(cmdf["cm_hit_t"])
             mrri_df_2["cm_hit_src"] = pd.Series(cmdf["cm_hit_src"])
             if tasks["draw_MRRI_plots"]:
-                draw_lineplots(mrri_df_2, extra_bases_roi, mrri_lineplot_path_2, draw_roi_box=True)
-                plot_energy_histos(mrri_df_2, results)
+                plot_jobs.append((draw_lineplots, (mrri_df_2, extra_bases_roi, mrri_lineplot_path_2),
+                                  dict(draw_roi_box=True, interactions=mrri_inter_2)))
+                plot_jobs.append((plot_energy_histos, (mrri_df_2, results), dict(interactions=mrri_inter_2)))
             if tasks["MEME+GLAM2_lineplots"]:
-                meme_to_lineplot(mrri_df_2, extra_bases_roi, meme_output)
-                glam2_to_lineplot(mrri_df_2, extra_bases_roi, meme_output) # HIGHLY improvised..
+                plot_jobs += meme_lineplot_jobs(mrri_df_2, extra_bases_roi, meme_output, interactions=mrri_inter_2)
+                plot_jobs += glam2_lineplot_jobs(mrri_df_2, extra_bases_roi, meme_output, interactions=mrri_inter_2) # HIGHLY improvised..
+        run_plot_jobs(plot_jobs, workers=jobs)
     if tasks["CDS_to_proteins"]:
         cds_to_proteins(parameter_table_file, amino_acids_output, extra_bases_roi)
     
\ No newline at end of file
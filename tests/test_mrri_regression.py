@@ -0,0 +1,85 @@
+import os
+import ast
+import pandas as pd
+import pytest
+from Codes.MRRI import MRRIParameters
+from Codes.intarna_backend import IntaRNABackend
+from Codes.intarna_help import create_MRRI_handler, MRRI_waves, mrri_predictions
+
+
+class RecordedBackend(IntaRNABackend):
+    """
+    Answers the MRRI rounds from the blocks of a raw MRRI output (see main_mrri)
+    instead of running IntaRNA, to check the MRRI rounds against a recorded run.
+    A round is found by its sequences and its --tAccConstr/--qAccConstr,
+    rounds that were not recorded give no interaction.
+    """
+
+    def __init__(self, blocks):
+        """
+        blocks (dict): (query, target) => list of recorded blocks of that genome
+        """
+        self.blocks = blocks
+
+    def run(self, query, target, args):
+        constraints = {"tAccConstr": "", "qAccConstr": ""}
+        cols = []
+        for arg in args:
+            if arg.startswith("--outCsvCols="):
+                cols = arg.split("=", 1)[1].split(",")
+            for name in constraints:
+                if arg.startswith(f"--{name}="):
+                    constraints[name] = arg.split("=", 1)[1]
+        header = ";".join(cols)
+        for block in self.blocks.get((query, target), []):
+            if all(block.get(name) == value for name, value in constraints.items()):
+                return [header + "\n" + ";".join(str(block[c]) for c in cols) + "\n", ""]
+        return [header + "\n", ""]
+
+
+def read_raw_mrri_output(raw_mrri_output):
+    """Reads the blocks of every genome from a raw MRRI output (see main_mrri), id => list of blocks."""
+    blocks = {}
+    with open(raw_mrri_output, "r") as f:
+        lines = f.read().split("\n")
+    for i in range(0, len(lines) - 2, 3):
+        blocks[lines[i].rstrip(" :")] = ast.literal_eval(lines[i+2])
+    return blocks
+
+
+def check_MRRI_output(mrri_file, raw_mrri_output, param_mode, **convergence):
+    """Replays the IntaRNA calls of a recorded run (raw output) with MRRI_waves
+    and compares the predictions with the recorded table.
+
+    mrri_file (str): Table written by main_mrri (e.g. Results/MRRI_output_2.csv)
+    raw_mrri_output (str): Raw output of the same run (e.g. Results/MRRI_raw_output_2.txt)
+    param_mode (int): param_mode of the run
+    convergence: Passed on to MRRI_waves
+
+    Output:
+    differences (list): Ids whose predictions differ from the table
+    """
+    df = pd.read_csv(mrri_file)
+    recorded = read_raw_mrri_output(raw_mrri_output)
+    params = MRRIParameters(backend=RecordedBackend({}))
+    handlers = [create_MRRI_handler(row["seq5"], row["seq3"], "", params=params) for index, row in df.iterrows()]
+    params.backend.blocks = {(next(iter(h.querySeq.values())), next(iter(h.targetSeq.values()))): recorded[vid]
+                             for h, vid in zip(handlers, df["id"])}
+    differences = []
+    for vid, interactions, (index, row) in zip(df["id"], MRRI_waves(handlers, param_mode, **convergence), df.iterrows()):
+        inter_ts, inter_qs = mrri_predictions(interactions) if "id2" in interactions[0] else ([], [])
+        if str(inter_ts) != row["predictions_t"] or str(inter_qs) != row["predictions_q"]:
+            differences.append(vid)
+    return differences
+
+
+results = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Results")
+
+
+@pytest.mark.parametrize("mode", [1, 2])
+def test_pipeline_defaults_match_recorded_run(mode):
+    mrri_file = f"{results}/MRRI_output_{mode}.csv"
+    raw_mrri_output = f"{results}/MRRI_raw_output_{mode}.txt"
+    if not (os.path.isfile(mrri_file) and os.path.isfile(raw_mrri_output)):
+        pytest.skip(f"No recorded MRRI run of mode {mode} in {results}")
+    assert check_MRRI_output(mrri_file, raw_mrri_output, mode) == []
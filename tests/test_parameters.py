@@ -0,0 +1,57 @@
+import os
+import random
+from Codes.parameters import (create_parameter_table, read_manifest, write_manifest,
+                              scan_database)
+
+
+def write_accession(root, vid, UTR5len=60, CDSlen=400, UTR3len=250):
+    """Writes {vid}.fa and {vid}.bed6 like the RefSeq database (class/type/virus dirs)."""
+    os.makedirs(root, exist_ok=True)
+    length = UTR5len + CDSlen + UTR3len
+    seq = "".join(random.choice("ACGT") for _ in range(length))
+    with open(f"{root}/{vid}.fa", "w") as f:
+        f.write(f">{vid} test\n")
+        for i in range(0, length, 70):
+            f.write(seq[i:i+70] + "\n")
+    with open(f"{root}/{vid}.bed6", "w") as f:
+        f.write(f"{vid}\t0\t{UTR5len}\tUTR5\t0\t+\n")
+        f.write(f"{vid}\t{UTR5len}\t{UTR5len+CDSlen}\tCDS\t0\t+\n")
+        f.write(f"{vid}\t{UTR5len+CDSlen}\t{length}\tUTR3\t0\t+\n")
+
+
+def test_unchanged_database_is_not_read_again(tmp_path):
+    random.seed(0)
+    database = tmp_path / "db"
+    for k in range(20):
+        root = f"{database}/MBFV/t{k % 2}/v{k % 5}"
+        write_accession(root, f"NC_{k:06d}.1")
+        ## mtimes with sub-microsecond digits, which a float mtime does not round trip
+        for ending in ("fa", "bed6"):
+            mtime_ns = 1792334206_000000000 + random.randrange(10**9)
+            os.utime(f"{root}/NC_{k:06d}.1.{ending}", ns=(mtime_ns, mtime_ns))
+    output = tmp_path / "parameter_table.csv"
+    create_parameter_table(str(database), 50, str(output), workers=2, index_dir=str(tmp_path / "index"))
+    manifest = read_manifest(f"{output}.manifest")
+    assert len(manifest) == 40
+
+    ## The manifest survives a write/read round trip unchanged
+    write_manifest(manifest, str(tmp_path / "copy.manifest"))
+    assert read_manifest(str(tmp_path / "copy.manifest")) == manifest
+
+    changed = [changed for record, entries, changed in scan_database(str(database), 50, manifest, workers=2)]
+    assert len(changed) == 20
+    assert sum(changed) == 0
+
+
+def test_changed_fasta_is_read_again(tmp_path):
+    random.seed(1)
+    database = tmp_path / "db"
+    for k in range(3):
+        write_accession(f"{database}/MBFV/t/v", f"NC_{k:06d}.1")
+    output = tmp_path / "parameter_table.csv"
+    create_parameter_table(str(database), 50, str(output), workers=1)
+    write_accession(f"{database}/MBFV/t/v", "NC_000001.1", UTR5len=80)
+    manifest = read_manifest(f"{output}.manifest")
+    read_again = [record[0] for record, entries, changed in scan_database(str(database), 50, manifest, workers=1)
+                  if changed]
+    assert read_again == ["NC_000001.1"]